@@ -1,6 +1,6 @@
 import os
 import re
-import json
+import bisect
 import uuid
 import time
 import unicodedata
@@ -8,20 +8,40 @@ import shutil
 import zipfile
 import subprocess
 import concurrent.futures
+import functools
+import hashlib
+import multiprocessing
+import queue
 import threading
+from collections import Counter, OrderedDict, deque
+from contextlib import closing, contextmanager
 from datetime import datetime, timedelta, timezone
-from io import BytesIO
-from typing import Dict, List, Literal, Optional, Tuple
+from io import RawIOBase
+from typing import Callable, Dict, Iterable, Iterator, List, Literal, Optional, Tuple, Union
 
 import fitz  # PyMuPDF
+import orjson
 import google.auth
 from google.auth.transport.requests import Request
 from google.cloud import storage
+from google.cloud.storage import transfer_manager
 from fastapi import FastAPI, UploadFile, File, HTTPException, BackgroundTasks, Header, Form
-from fastapi.responses import Response, StreamingResponse, RedirectResponse
+from fastapi.responses import FileResponse, Response, StreamingResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel, Field
 
+# Paralelismo por página (OCR_WORKERS) en vez de hilos OpenMP dentro de Tesseract, que
+# compiten entre sí. Debe fijarse antes de cargar libtesseract; el CLI lo hereda.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+try:
+    # OCR en proceso (sin fork/exec ni carga de modelo por página). Opcional:
+    # requiere libtesseract-dev para compilar; sin él se usa el CLI `tesseract`.
+    import tesserocr
+except ImportError:
+    tesserocr = None
+
 
 # ----------------------------
 # Config
@@ -30,38 +50,102 @@ JOB_ROOT = os.environ.get("TIPIFICADOR_JOB_ROOT", "/tmp/tipificador_jobs")
 os.makedirs(JOB_ROOT, exist_ok=True)
 BATCH_ROOT = os.path.join(JOB_ROOT, "batches")
 os.makedirs(BATCH_ROOT, exist_ok=True)
+# Miniaturas por contenido del PDF fuente, compartidas entre jobs
+THUMB_CACHE_ROOT = os.path.join(JOB_ROOT, "thumbs")
+os.makedirs(THUMB_CACHE_ROOT, exist_ok=True)
 
 CATEGORIES = ["CRC", "FEV", "HEV", "OPF", "PDE"]
 Category = Literal["CRC", "FEV", "HEV", "OPF", "PDE"]
 SERVICE_IDS = {"cuidador", "otros_servicios"}
 
 THUMB_WIDTH = 240
+THUMB_JPG_QUALITY = 80
 VIEW_WIDTH = 1100
+# Nivel de anti-aliasing de MuPDF (0-8). Es global al proceso (afecta también OCR),
+# por eso solo se cambia si se configura explícitamente.
+RENDER_AA_LEVEL = os.environ.get("TIPIFICADOR_RENDER_AA_LEVEL", "").strip()
 
 MAX_FILE_BYTES = int(os.environ.get("TIPIFICADOR_MAX_FILE_BYTES", "104857600"))  # 100MB
+UPLOAD_CHUNK_BYTES = 8 * 1024 * 1024
+# Subidas ya volcadas a disco por Starlette desde este tamaño se copian con sendfile
+UPLOAD_SENDFILE_MIN_BYTES = 4 * 1024 * 1024
+PDF_MAGIC = b"%PDF-"
+# La especificación permite basura antes del encabezado dentro del primer KB.
+PDF_HEADER_SEARCH_BYTES = 1024
 MAX_FILES = int(os.environ.get("TIPIFICADOR_MAX_FILES", "20"))
 JOB_TTL_SECONDS = int(os.environ.get("TIPIFICADOR_JOB_TTL_SECONDS", "21600"))  # 6 hours
 CACHE_VIEW = os.environ.get("TIPIFICADOR_CACHE_VIEW", "1").lower() not in {"0", "false", "no"}
+# Las imágenes de una página no cambian durante la vida del job (la URL incluye el jobId)
+PAGE_IMAGE_CACHE_CONTROL = "private, max-age=3600"
+THUMB_PRERENDER = os.environ.get("TIPIFICADOR_THUMB_PRERENDER", "1").lower() not in {"0", "false", "no"}
+# Miniaturas compartidas entre jobs (por hash del PDF). Se renuevan al usarse una vez pasado
+# THUMB_REFRESH_AGE_SECONDS, así que duran al menos JOB_TTL_SECONDS desde el último uso.
+THUMB_CACHE_TTL_SECONDS = max(
+    JOB_TTL_SECONDS,
+    int(os.environ.get("TIPIFICADOR_THUMB_CACHE_TTL_SECONDS", str(2 * JOB_TTL_SECONDS))),
+)
+THUMB_REFRESH_AGE_SECONDS = THUMB_CACHE_TTL_SECONDS - JOB_TTL_SECONDS
 OCR_ENABLED = os.environ.get("TIPIFICADOR_OCR_ENABLED", "1").lower() not in {"0", "false", "no"}
 OCR_LANG = os.environ.get("TIPIFICADOR_OCR_LANG", "spa+eng")
 OCR_DPI = int(os.environ.get("TIPIFICADOR_OCR_DPI", "300"))
 OCR_PSM = os.environ.get("TIPIFICADOR_OCR_PSM", "4")
 OCR_HEADER_RATIO = float(os.environ.get("TIPIFICADOR_OCR_HEADER_RATIO", "0.35"))
 OCR_HEADER_DPI = int(os.environ.get("TIPIFICADOR_OCR_HEADER_DPI", str(min(200, OCR_DPI))))
+# OCR completo de la clasificación automática: basta para detectar encabezados y tablas.
+# OCR_DPI queda para el texto que ve el usuario (/ocr.txt).
+OCR_CLASSIFY_DPI = int(os.environ.get("TIPIFICADOR_OCR_CLASSIFY_DPI", str(min(200, OCR_DPI))))
 OCR_MIN_TEXT_LEN = int(os.environ.get("TIPIFICADOR_OCR_MIN_TEXT_LEN", "40"))
 OCR_KEEP_IMAGES = os.environ.get("TIPIFICADOR_OCR_KEEP_IMAGES", "0").lower() in {"1", "true", "yes"}
+# OCR de cabecera sobre páginas con texto embebido que no clasificó (p. ej. logo/título escaneado).
+OCR_DOUBLE_CHECK = os.environ.get("TIPIFICADOR_DOUBLE_CHECK_OCR", "1").lower() not in {"0", "false", "no"}
 OCR_WORKERS = int(os.environ.get("TIPIFICADOR_OCR_WORKERS", "4"))
+# PyMuPDF retiene el GIL y no soporta uso multihilo de un mismo documento: en hilos casi
+# no hay paralelismo real. Opt-in (>1) solo si una medición en el despliegue lo justifica.
+PDF_WORKERS = max(1, int(os.environ.get("TIPIFICADOR_PDF_WORKERS", "1")))
+# >0: los lotes corren en procesos aparte (PyMuPDF retiene el GIL); 0: hilo por lote.
+BATCH_PROCESSES = int(os.environ.get("TIPIFICADOR_BATCH_PROCESSES", "0"))
+# Con BATCH_PROCESSES=0: lotes simultáneos en hilos; los demás esperan en cola hasta el límite
+BATCH_WORKERS = max(1, int(os.environ.get("TIPIFICADOR_BATCH_WORKERS", "2")))
+BATCH_QUEUE_LIMIT = max(1, int(os.environ.get("TIPIFICADOR_BATCH_QUEUE_LIMIT", "20")))
+# Paquetes de un mismo lote procesados en paralelo (cada uno ya usa OCR_WORKERS hilos)
+BATCH_PACKAGE_WORKERS = max(1, int(os.environ.get("TIPIFICADOR_BATCH_PACKAGE_WORKERS", "1")))
+# garbage=4 elimina objetos no referenciados y deduplica streams en los PDFs de salida
+OUTPUT_PDF_GARBAGE = int(os.environ.get("TIPIFICADOR_OUTPUT_PDF_GARBAGE", "4"))
 PDF_REWRITE_ENABLED = os.environ.get("TIPIFICADOR_PDF_REWRITE_ENABLED", "1").lower() not in {"0", "false", "no"}
+# Los PDFs ya vienen comprimidos (FlateDecode); deflate extra solo cuesta CPU.
+ZIP_COMPRESS = os.environ.get("TIPIFICADOR_ZIP_COMPRESS", "0").lower() in {"1", "true", "yes"}
+ZIP_COMPRESSION = zipfile.ZIP_DEFLATED if ZIP_COMPRESS else zipfile.ZIP_STORED
+# Con ZIP_COMPRESS activo: nivel 1 (BEST_SPEED), el nivel 6 no gana casi nada sobre PDFs
+ZIP_COMPRESSLEVEL = int(os.environ.get("TIPIFICADOR_ZIP_COMPRESSLEVEL", "1"))
+ZIP_STREAM_SMALL_CHUNK = 64 * 1024
 MAX_BATCH_PACKAGES = int(os.environ.get("TIPIFICADOR_MAX_BATCH_PACKAGES", "10"))
 MAX_BATCH_BYTES = int(os.environ.get("TIPIFICADOR_MAX_BATCH_BYTES", "524288000"))  # 500MB
+# Tamaño descomprimido máximo del ZIP de lote (protección contra zip bombs); los PDFs casi
+# no comprimen, así que 4x el límite de subida es holgado.
+MAX_BATCH_EXTRACTED_BYTES = int(
+    os.environ.get("TIPIFICADOR_MAX_BATCH_EXTRACTED_BYTES", str(MAX_BATCH_BYTES * 4))
+)
 GCS_BUCKET = os.environ.get("TIPIFICADOR_GCS_BUCKET", "").strip()
 GCS_UPLOAD_PREFIX = os.environ.get("TIPIFICADOR_GCS_UPLOAD_PREFIX", "uploads/").strip()
 GCS_RESULTS_PREFIX = os.environ.get("TIPIFICADOR_GCS_RESULTS_PREFIX", "results/").strip()
 GCS_SIGNED_URL_EXP_SECONDS = int(os.environ.get("TIPIFICADOR_GCS_SIGNED_URL_EXP_SECONDS", "3600"))
 GCS_SIGNER_EMAIL = os.environ.get("TIPIFICADOR_GCS_SIGNER_EMAIL", "").strip()
+GCS_DOWNLOAD_WORKERS = int(os.environ.get("TIPIFICADOR_GCS_DOWNLOAD_WORKERS", "8"))
+GCS_UPLOAD_WORKERS = int(os.environ.get("TIPIFICADOR_GCS_UPLOAD_WORKERS", "8"))
+GCS_DOWNLOAD_CHUNK_BYTES = 32 * 1024 * 1024
 CLEANUP_TOKEN = os.environ.get("TIPIFICADOR_CLEANUP_TOKEN", "").strip()
 CLEANUP_AGE_MINUTES = int(os.environ.get("TIPIFICADOR_CLEANUP_AGE_MINUTES", "30"))
 
+META_CACHE_SIZE = 64
+DOC_CACHE_SIZE = 32
+DOC_CACHE_IDLE_SECONDS = 300
+PDF_TEXTS_CACHE_SIZE = 32
+# Páginas por proceso tesseract en el OCR por lotes del CLI (acota las imágenes en disco)
+OCR_CLI_BATCH_PAGES = 16
+
+if RENDER_AA_LEVEL:
+    fitz.TOOLS.set_aa_level(int(RENDER_AA_LEVEL))
+
 _JOB_ID_RE = re.compile(r"^[a-f0-9]{32}$", re.IGNORECASE)
 _NIT_RE = re.compile(
     r"\bNIT\b\s*[:\-]?\s*([0-9\.\, ]{6,15}(?:\s*-\s*\d)?)",
@@ -69,13 +153,40 @@ _NIT_RE = re.compile(
 )
 _OCFE_RE = re.compile(r"\bOCFE\s*(\d{3,})\b", flags=re.IGNORECASE)
 _INVOICE_RE = re.compile(r"\b([A-Z]{3,6})\s*(\d{3,})\b")
+_NON_DIGIT_RE = re.compile(r"\D")
+_UNSAFE_OBJECT_CHARS_RE = re.compile(r"[^A-Za-z0-9._-]+")
+_NON_ALNUM_SPACE_RE = re.compile(r"[^A-Z0-9 ]+")
+_WHITESPACE_RE = re.compile(r"\s+")
+_REGISTRO_INDIVIDUAL_RE = re.compile(r"REGISTR[O0]\s+INDIVID")
+_OPF_DECISIONES_RE = re.compile(r"\bORDEN\s+MEDICA\s*\(?DECISIONES\)?\b")
+_INVOICE_PREFIX_EXCLUDED = frozenset({"NIT", "CUDE"})
 _INVOICE_HINTS = ("FACTURA", "ELECTR", "VENTA", "N°", "NO.", "NRO", "CUFE", "BUFE")
+# Todas las pistas en una sola búsqueda (bloques cortos, evaluados por cada bloque de cabecera)
+_INVOICE_HINTS_RE = re.compile("|".join(re.escape(h) for h in _INVOICE_HINTS))
 _FECHA_CREACION_RE = re.compile(
     r"FECHA\s*DE\s*CREA(?:CION|CIÓN)\s*[:\-]?\s*(\d{2}/\d{2}/\d{4})",
     flags=re.IGNORECASE,
 )
 _DATE_RE = re.compile(r"\b\d{2}/\d{2}/\d{4}\b")
 _TIME_RE = re.compile(r"\b\d{2}:\d{2}\b")
+# Latin-1 no tiene marcas combinantes: quitar tildes carácter a carácter equivale a NFD.
+_LATIN1_ACCENTS_TABLE = {
+    cp: "".join(
+        ch for ch in unicodedata.normalize("NFD", chr(cp)) if unicodedata.category(ch) != "Mn"
+    )
+    for cp in range(0x80, 0x100)
+    if unicodedata.normalize("NFD", chr(cp)) != chr(cp)
+}
+# Las mismas tablas byte a byte para bytes.translate (mucho más rápido que str.translate).
+# Quitar una tilde Latin-1 siempre deja un solo carácter Latin-1.
+_LATIN1_ACCENTS_BYTES = bytes(
+    ord(chr(cp).translate(_LATIN1_ACCENTS_TABLE)) for cp in range(0x100)
+)
+# Quitar tildes + mayúsculas en una pasada; "ß" -> "SS" y "µ" -> "Μ" no caben en un byte.
+_LATIN1_FOLD_UPPER_BYTES = bytes(
+    cp if ch in "ßµ" else ord(ch.translate(_LATIN1_ACCENTS_TABLE).upper())
+    for cp, ch in ((cp, chr(cp)) for cp in range(0x100))
+)
 _FEV_HINTS = ("FACTURA ELECTRONICA DE VENTA", "FACTURA ELECTRÓNICA DE VENTA")
 _NC_HINTS = ("NOTA DE CREDITO ELECTRONICA", "NOTA DE CRÉDITO ELECTRONICA")
 _AUTO_RULES_STRONG: List[Tuple[str, Tuple[str, ...]]] = [
@@ -138,53 +249,169 @@ def _assert_job_id(job_id: str) -> None:
         raise HTTPException(status_code=404, detail="Job no existe o expiró.")
 
 
+# job_id -> (mtime_ns, meta). Evita re-parsear meta.json en cada thumb/view.
+_META_CACHE: "OrderedDict[str, Tuple[int, dict]]" = OrderedDict()
+_META_CACHE_LOCK = threading.Lock()
+
+
 def _load_meta(job_id: str) -> dict:
     _assert_job_id(job_id)
     path = _meta_path(job_id)
-    if not os.path.exists(path):
+    try:
+        mtime_ns = os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        with _META_CACHE_LOCK:
+            _META_CACHE.pop(job_id, None)
         raise HTTPException(status_code=404, detail="Job no existe o expiró.")
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    with _META_CACHE_LOCK:
+        cached = _META_CACHE.get(job_id)
+        if cached and cached[0] == mtime_ns:
+            _META_CACHE.move_to_end(job_id)
+            return cached[1]
+    with open(path, "rb") as f:
+        meta = orjson.loads(f.read())
+    if "page_map" in meta and "pdf_idx" not in meta:
+        # Jobs creados antes del formato SoA: [[pdf_idx, page_idx], ...]
+        page_map = meta.pop("page_map")
+        meta["pdf_idx"] = [pair[0] for pair in page_map]
+        meta["page_idx"] = [pair[1] for pair in page_map]
+    _cache_meta(job_id, mtime_ns, meta)
+    return meta
+
+
+def _cache_meta(job_id: str, mtime_ns: int, meta: dict) -> None:
+    with _META_CACHE_LOCK:
+        _META_CACHE[job_id] = (mtime_ns, meta)
+        _META_CACHE.move_to_end(job_id)
+        while len(_META_CACHE) > META_CACHE_SIZE:
+            _META_CACHE.popitem(last=False)
 
 
 def _save_meta(job_id: str, meta: dict) -> None:
-    with open(_meta_path(job_id), "w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False, indent=2)
+    # Escritura atómica y durable (tmp + fsync + rename), como _save_batch_meta:
+    # un lector o un reinicio nunca encuentran un meta.json truncado.
+    path = _meta_path(job_id)
+    # tmp único por escritura, igual que _save_batch_meta: dos guardados concurrentes no
+    # escriben sobre el mismo archivo temporal.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(orjson.dumps(meta))
+        f.flush()
+        os.fsync(f.fileno())
+        mtime_ns = os.fstat(f.fileno()).st_mtime_ns
+    # Lo recién escrito queda en caché con su mtime: la siguiente lectura no re-parsea.
+    # Reemplazo y caché bajo el mismo lock, para que la caché coincida con el disco.
+    with _META_CACHE_LOCK:
+        os.replace(tmp_path, path)
+        _META_CACHE[job_id] = (mtime_ns, meta)
+        _META_CACHE.move_to_end(job_id)
+        while len(_META_CACHE) > META_CACHE_SIZE:
+            _META_CACHE.popitem(last=False)
 
 
 def _batch_meta_path(batch_id: str) -> str:
     return os.path.join(_batch_dir(batch_id), "meta.json")
 
 
+# batch_id -> ((mtime_ns, size), bytes del meta.json). Se guardan los bytes y no el dict:
+# handlers y el hilo del lote modifican el meta en sitio antes de guardarlo.
+_BATCH_META_CACHE: "OrderedDict[str, Tuple[Tuple[int, int], bytes]]" = OrderedDict()
+_BATCH_META_CACHE_LOCK = threading.Lock()
+
+
+def _cache_batch_meta(batch_id: str, stamp: Tuple[int, int], raw: bytes) -> None:
+    with _BATCH_META_CACHE_LOCK:
+        _BATCH_META_CACHE[batch_id] = (stamp, raw)
+        _BATCH_META_CACHE.move_to_end(batch_id)
+        while len(_BATCH_META_CACHE) > META_CACHE_SIZE:
+            _BATCH_META_CACHE.popitem(last=False)
+
+
 def _load_batch_meta(batch_id: str) -> dict:
     path = _batch_meta_path(batch_id)
-    if not os.path.exists(path):
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        with _BATCH_META_CACHE_LOCK:
+            _BATCH_META_CACHE.pop(batch_id, None)
         raise HTTPException(status_code=404, detail="Batch no existe o expiró.")
-    for _ in range(3):
-        try:
-            with open(path, "r", encoding="utf-8") as f:
-                return json.load(f)
-        except json.JSONDecodeError:
-            time.sleep(0.05)
-    raise HTTPException(status_code=503, detail="Batch temporalmente ocupado, intenta de nuevo.")
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _BATCH_META_CACHE_LOCK:
+        cached = _BATCH_META_CACHE.get(batch_id)
+        if cached and cached[0] == stamp:
+            _BATCH_META_CACHE.move_to_end(batch_id)
+            return orjson.loads(cached[1])
+    # _save_batch_meta escribe con rename atómico y tmp propio por escritura; aun así, un
+    # archivo ilegible (disco lleno, copia externa) responde 503 y no queda en caché.
+    with open(path, "rb") as f:
+        raw = f.read()
+    try:
+        meta = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=503, detail="Batch meta no disponible temporalmente. Reintenta.")
+    _cache_batch_meta(batch_id, stamp, raw)
+    return meta
 
 
-def _save_batch_meta(batch_id: str, meta: dict) -> None:
+def _save_batch_meta(batch_id: str, meta: dict, durable: bool = True) -> None:
+    """
+    Escritura atómica (tmp + rename). durable=False omite el fsync: para el progreso
+    por paquete basta con que los lectores nunca vean un archivo a medias.
+    """
     path = _batch_meta_path(batch_id)
-    tmp_path = f"{path}.tmp"
-    with open(tmp_path, "w", encoding="utf-8") as f:
-        json.dump(meta, f, ensure_ascii=False, indent=2)
+    # tmp único por escritura: el hilo del lote, GET /batch y cancel/retry pueden guardar a
+    # la vez, y con un tmp compartido uno truncaría el archivo que el otro está escribiendo.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    raw = orjson.dumps(meta)
+    with open(tmp_path, "wb") as f:
+        f.write(raw)
         f.flush()
-        os.fsync(f.fileno())
-    os.replace(tmp_path, path)
+        if durable:
+            os.fsync(f.fileno())
+        st = os.fstat(f.fileno())
+    # Reemplazo y caché bajo el mismo lock: dos guardados concurrentes no pueden dejar
+    # en caché una versión distinta a la que quedó en disco.
+    with _BATCH_META_CACHE_LOCK:
+        os.replace(tmp_path, path)
+        _BATCH_META_CACHE[batch_id] = ((st.st_mtime_ns, st.st_size), raw)
+        _BATCH_META_CACHE.move_to_end(batch_id)
+        while len(_BATCH_META_CACHE) > META_CACHE_SIZE:
+            _BATCH_META_CACHE.popitem(last=False)
 
 
 def _gcs_enabled() -> bool:
     return bool(GCS_BUCKET)
 
 
+_GCS_CLIENT: Optional[storage.Client] = None
+_GCS_CREDENTIALS = None
+_GCS_LOCK = threading.Lock()
+# Renovar el token un poco antes de que expire para que las URLs firmadas sean válidas.
+GCS_TOKEN_REFRESH_MARGIN = timedelta(seconds=60)
+
+
 def _gcs_client() -> storage.Client:
-    return storage.Client()
+    global _GCS_CLIENT
+    if _GCS_CLIENT is None:
+        with _GCS_LOCK:
+            if _GCS_CLIENT is None:
+                _GCS_CLIENT = storage.Client()
+    return _GCS_CLIENT
+
+
+def _get_credentials():
+    global _GCS_CREDENTIALS
+    with _GCS_LOCK:
+        if _GCS_CREDENTIALS is None:
+            _GCS_CREDENTIALS, _ = google.auth.default(
+                scopes=["https://www.googleapis.com/auth/cloud-platform"]
+            )
+        credentials = _GCS_CREDENTIALS
+        expiry = credentials.expiry  # UTC sin tzinfo, como lo maneja google.auth
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        if not credentials.token or (expiry is not None and expiry - now < GCS_TOKEN_REFRESH_MARGIN):
+            credentials.refresh(Request())
+    return credentials
 
 
 def _normalize_prefix(prefix: str) -> str:
@@ -196,7 +423,7 @@ def _normalize_prefix(prefix: str) -> str:
 def _safe_object_name(name: str) -> str:
     base = os.path.basename(name or "batch.zip")
     base = base.replace(" ", "_")
-    return re.sub(r"[^A-Za-z0-9._-]+", "_", base)
+    return _UNSAFE_OBJECT_CHARS_RE.sub("_", base)
 
 
 def _parse_gcs_path(path: str) -> Tuple[str, str]:
@@ -261,9 +488,7 @@ def _signed_url(
     content_type: Optional[str] = None,
     download_name: Optional[str] = None,
 ) -> str:
-    credentials, _ = google.auth.default(scopes=["https://www.googleapis.com/auth/cloud-platform"])
-    if not credentials.valid:
-        credentials.refresh(Request())
+    credentials = _get_credentials()
     signer_email = _get_signer_email(credentials)
     if not signer_email:
         raise HTTPException(status_code=500, detail="GCS signer email no configurado.")
@@ -295,6 +520,20 @@ def _generate_download_url(object_name: str, download_name: Optional[str] = None
     return _signed_url(blob, method="GET", download_name=download_name)
 
 
+def _download_blob_to_path(blob: storage.Blob, path: str) -> None:
+    # ZIPs grandes: descarga por rangos en paralelo (hilos, el trabajo es de red).
+    if GCS_DOWNLOAD_WORKERS > 1 and blob.size and blob.size > GCS_DOWNLOAD_CHUNK_BYTES:
+        transfer_manager.download_chunks_concurrently(
+            blob,
+            path,
+            chunk_size=GCS_DOWNLOAD_CHUNK_BYTES,
+            worker_type=transfer_manager.THREAD,
+            max_workers=GCS_DOWNLOAD_WORKERS,
+        )
+    else:
+        blob.download_to_filename(path)
+
+
 def _restore_batch_input_from_gcs(batch_id: str, source_gcs_path: str) -> None:
     if not _gcs_enabled():
         raise HTTPException(status_code=400, detail="GCS no está configurado en el servidor.")
@@ -304,8 +543,8 @@ def _restore_batch_input_from_gcs(batch_id: str, source_gcs_path: str) -> None:
 
     client = _gcs_client()
     bucket = client.bucket(bucket_name)
-    blob = bucket.blob(object_name)
-    if not blob.exists():
+    blob = bucket.get_blob(object_name)
+    if blob is None:
         raise HTTPException(status_code=404, detail="Objeto no encontrado en GCS.")
 
     bdir = _batch_dir(batch_id)
@@ -316,7 +555,7 @@ def _restore_batch_input_from_gcs(batch_id: str, source_gcs_path: str) -> None:
         shutil.rmtree(input_dir, ignore_errors=True)
     os.makedirs(input_dir, exist_ok=True)
 
-    blob.download_to_filename(zip_path)
+    _download_blob_to_path(blob, zip_path)
     with zipfile.ZipFile(zip_path, "r") as zf:
         _safe_extract_zip(zf, input_dir)
 
@@ -361,9 +600,84 @@ def _reconcile_batch_meta(batch_id: str, meta: dict) -> dict:
     return meta
 
 
+_TRASH_SUFFIX = ".deleting"
+# Un solo hilo borra los directorios en cola: una limpieza de muchos jobs no lanza
+# un rmtree concurrente por job compitiendo por el disco.
+_TRASH_QUEUE: "queue.Queue[str]" = queue.Queue()
+_TRASH_THREAD: Optional[threading.Thread] = None
+_TRASH_THREAD_LOCK = threading.Lock()
+
+
+def _trash_worker() -> None:
+    while True:
+        path = _TRASH_QUEUE.get()
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def _discard_job(job_id: str) -> None:
+    """
+    Elimina el job sin bloquear al llamador: se renombra (instantáneo, el job deja de
+    existir de inmediato) y el directorio se borra en un hilo aparte.
+    """
+    global _TRASH_THREAD
+    _forget_source_pdfs(job_id)
+    jdir = _job_dir(job_id)
+    trash = f"{jdir}{_TRASH_SUFFIX}"
+    try:
+        os.rename(jdir, trash)
+    except OSError:
+        trash = jdir
+    _TRASH_QUEUE.put(trash)
+    with _TRASH_THREAD_LOCK:
+        if _TRASH_THREAD is None:
+            _TRASH_THREAD = threading.Thread(target=_trash_worker, daemon=True)
+            _TRASH_THREAD.start()
+
+
+_THUMB_SWEEP_LOCK = threading.Lock()
+_THUMB_SWEEP_AT = 0.0
+
+
+def _cleanup_shared_thumbs(now: float) -> None:
+    global _THUMB_SWEEP_AT
+    # Como mucho un barrido cada 10 minutos: el directorio puede tener miles de archivos
+    with _THUMB_SWEEP_LOCK:
+        if now - _THUMB_SWEEP_AT < min(600, THUMB_CACHE_TTL_SECONDS):
+            return
+        _THUMB_SWEEP_AT = now
+    with os.scandir(THUMB_CACHE_ROOT) as it:
+        for entry in it:
+            try:
+                if now - entry.stat().st_mtime > THUMB_CACHE_TTL_SECONDS:
+                    os.remove(entry.path)
+            except OSError:
+                continue
+
+
+_JOB_CLEANUP_LOCK = threading.Lock()
+_JOB_CLEANUP_AT = 0.0
+JOB_CLEANUP_INTERVAL_SECONDS = 60
+
+
+def _cleanup_expired_jobs_throttled() -> None:
+    # Tarea de fondo tras cada carga: con muchas cargas seguidas basta un barrido por minuto
+    global _JOB_CLEANUP_AT
+    with _JOB_CLEANUP_LOCK:
+        now = time.time()
+        if now - _JOB_CLEANUP_AT < JOB_CLEANUP_INTERVAL_SECONDS:
+            return
+        _JOB_CLEANUP_AT = now
+    _cleanup_expired_jobs()
+
+
 def _cleanup_expired_jobs() -> None:
     now = time.time()
+    _cleanup_shared_thumbs(now)
     for name in os.listdir(JOB_ROOT):
+        if name.endswith(_TRASH_SUFFIX):
+            # Borrado interrumpido (reinicio del proceso)
+            shutil.rmtree(os.path.join(JOB_ROOT, name), ignore_errors=True)
+            continue
         if not _JOB_ID_RE.fullmatch(name or ""):
             continue
         jdir = os.path.join(JOB_ROOT, name)
@@ -371,31 +685,101 @@ def _cleanup_expired_jobs() -> None:
         if not os.path.isfile(meta_path):
             continue
         try:
-            with open(meta_path, "r", encoding="utf-8") as f:
-                meta = json.load(f)
+            with open(meta_path, "rb") as f:
+                meta = orjson.loads(f.read())
             created_at = float(meta.get("createdAt", 0))
         except Exception:
             created_at = 0
         if created_at and (now - created_at) > JOB_TTL_SECONDS:
-            shutil.rmtree(jdir, ignore_errors=True)
+            _discard_job(name)
+
+
+def _has_pdf_header(head: bytes) -> bool:
+    return PDF_MAGIC in head[:PDF_HEADER_SEARCH_BYTES]
+
 
+def _spooled_upload_fd(uf: UploadFile) -> Optional[int]:
+    # Starlette usa SpooledTemporaryFile: las subidas grandes ya están en un archivo temporal
+    if not hasattr(os, "sendfile") or not getattr(uf.file, "_rolled", False):
+        return None
+    try:
+        fd = uf.file.fileno()
+        if os.fstat(fd).st_size < UPLOAD_SENDFILE_MIN_BYTES:
+            return None
+    except (AttributeError, OSError, ValueError):
+        return None
+    return fd
+
+
+def _copy_spooled_upload(
+    src_fd: int,
+    dest_path: str,
+    max_bytes: int,
+    require_pdf: bool,
+    filename: Optional[str],
+) -> bool:
+    """
+    Copia la subida dentro del kernel (sendfile), sin pasar los datos por Python.
+    Devuelve False si el sistema no lo soporta, para usar la copia por bloques.
+    """
+    size = os.fstat(src_fd).st_size
+    if size > max_bytes:
+        raise HTTPException(status_code=413, detail="Archivo demasiado grande.")
+    if require_pdf and not _has_pdf_header(os.pread(src_fd, PDF_HEADER_SEARCH_BYTES, 0)):
+        raise HTTPException(status_code=400, detail=f"PDF inválido o corrupto: {filename}")
+    try:
+        with open(dest_path, "wb") as out:
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(out.fileno(), src_fd, offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+    except OSError:
+        try:
+            os.remove(dest_path)
+        except FileNotFoundError:
+            pass
+        return False
+    return True
+
+
+async def _save_upload_file_limited(
+    uf: UploadFile,
+    dest_path: str,
+    max_bytes: int,
+    require_pdf: bool = False,
+) -> None:
+    src_fd = _spooled_upload_fd(uf)
+    if src_fd is not None and await run_in_threadpool(
+        _copy_spooled_upload, src_fd, dest_path, max_bytes, require_pdf, uf.filename
+    ):
+        await uf.close()
+        return
 
-async def _save_upload_file_limited(uf: UploadFile, dest_path: str, max_bytes: int) -> None:
     total = 0
+    error: Optional[HTTPException] = None
     with open(dest_path, "wb") as out:
         while True:
-            chunk = await uf.read(1024 * 1024)
+            chunk = await uf.read(UPLOAD_CHUNK_BYTES)
             if not chunk:
                 break
+            if require_pdf and total == 0 and not _has_pdf_header(chunk):
+                error = HTTPException(status_code=400, detail=f"PDF inválido o corrupto: {uf.filename}")
+                break
             total += len(chunk)
             if total > max_bytes:
-                out.close()
-                try:
-                    os.remove(dest_path)
-                except FileNotFoundError:
-                    pass
-                raise HTTPException(status_code=413, detail="Archivo demasiado grande.")
+                error = HTTPException(status_code=413, detail="Archivo demasiado grande.")
+                break
             out.write(chunk)
+    if error is None and require_pdf and total == 0:
+        error = HTTPException(status_code=400, detail=f"PDF inválido o corrupto: {uf.filename}")
+    if error is not None:
+        try:
+            os.remove(dest_path)
+        except FileNotFoundError:
+            pass
+        raise error
     await uf.close()
 
 
@@ -409,7 +793,23 @@ def _is_probably_pdf(uf: UploadFile) -> bool:
     return True
 
 
+def _extract_zip_members(zf: zipfile.ZipFile, pairs: List[Tuple[zipfile.ZipInfo, str]]) -> None:
+    for member, target in pairs:
+        with zf.open(member) as src, open(target, "wb") as out:
+            shutil.copyfileobj(src, out, UPLOAD_CHUNK_BYTES)
+
+
+def _extract_zip_members_from_path(zip_path: str, pairs: List[Tuple[zipfile.ZipInfo, str]]) -> None:
+    # ZipFile propio por hilo: un mismo ZipFile no se debe leer desde varios hilos
+    with zipfile.ZipFile(zip_path, "r") as zf:
+        _extract_zip_members(zf, pairs)
+
+
 def _safe_extract_zip(zf: zipfile.ZipFile, dest_dir: str) -> None:
+    # Validación y carpetas en serie; luego los miembros se descomprimen en paralelo
+    # (zlib libera el GIL).
+    created_dirs = set()
+    pairs: List[Tuple[zipfile.ZipInfo, str]] = []
     for member in zf.infolist():
         name = member.filename
         if not name or name.endswith("/"):
@@ -418,27 +818,56 @@ def _safe_extract_zip(zf: zipfile.ZipFile, dest_dir: str) -> None:
         if norm.startswith("..") or os.path.isabs(norm):
             raise HTTPException(status_code=400, detail="ZIP inválido: rutas inseguras.")
         target = os.path.join(dest_dir, norm)
-        os.makedirs(os.path.dirname(target), exist_ok=True)
-        with zf.open(member) as src, open(target, "wb") as out:
-            shutil.copyfileobj(src, out)
+        parent = os.path.dirname(target)
+        if parent not in created_dirs:
+            os.makedirs(parent, exist_ok=True)
+            created_dirs.add(parent)
+        pairs.append((member, target))
+    # file_size viene del directorio central, pero zipfile nunca entrega más bytes que
+    # ese valor: la suma acota lo que se va a escribir antes de descomprimir nada.
+    if sum(member.file_size for member, _ in pairs) > MAX_BATCH_EXTRACTED_BYTES:
+        raise HTTPException(
+            status_code=413,
+            detail=f"ZIP demasiado grande descomprimido (máximo {MAX_BATCH_EXTRACTED_BYTES // (1024*1024)}MB).",
+        )
+
+    workers = min(PDF_WORKERS, len(pairs))
+    if workers <= 1 or not zf.filename:
+        _extract_zip_members(zf, pairs)
+        return
+    # Repartir por tamaño: cada hilo recibe miembros alternos de la lista ordenada
+    pairs.sort(key=lambda pair: pair[0].file_size, reverse=True)
+    shards = [pairs[k::workers] for k in range(workers)]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        for future in [executor.submit(_extract_zip_members_from_path, zf.filename, shard) for shard in shards]:
+            future.result()
 
 
 def _collect_pdf_paths(root: str) -> List[str]:
     pdfs: List[str] = []
-    for base, _, files in os.walk(root):
-        for name in files:
-            if name.lower().endswith(".pdf"):
-                pdfs.append(os.path.join(base, name))
+    stack = [root]
+    while stack:
+        try:
+            it = os.scandir(stack.pop())
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.name.lower().endswith(".pdf") and entry.is_file():
+                    pdfs.append(entry.path)
     return sorted(pdfs)
 
 
-def _rewrite_pdf_structure_inplace(path: str) -> None:
+def _rewrite_pdf_structure_inplace(path: str) -> Optional[int]:
     """
     Reescribe el PDF para normalizar estructura interna (xref/objetos).
     Esto reduce errores de insercion de paginas en lotes con PDFs escaneados.
+    Devuelve el número de páginas del PDF normalizado, o None si no se reescribió.
     """
     if not PDF_REWRITE_ENABLED:
-        return
+        return None
     tmp_path = f"{path}.normalized.pdf"
     doc: Optional[fitz.Document] = None
     try:
@@ -448,8 +877,10 @@ def _rewrite_pdf_structure_inplace(path: str) -> None:
         doc = None
         # Validar que el PDF normalizado abre correctamente antes de reemplazar.
         check = fitz.open(tmp_path)
+        page_count = check.page_count
         check.close()
         os.replace(tmp_path, path)
+        return page_count
     except Exception:
         # Fallback seguro: conservar original si falla la normalizacion.
         try:
@@ -457,11 +888,69 @@ def _rewrite_pdf_structure_inplace(path: str) -> None:
                 os.remove(tmp_path)
         except OSError:
             pass
+        return None
     finally:
         if doc is not None:
             doc.close()
 
 
+def _file_digest(path: str) -> str:
+    h = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(UPLOAD_CHUNK_BYTES)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _prepare_source_pdf(src_path: str, display_name: str) -> Tuple[int, str, bool]:
+    # Hash del archivo tal como se subió (antes de reescribirlo)
+    digest = _file_digest(src_path)
+    page_count = _rewrite_pdf_structure_inplace(src_path)
+    if page_count:
+        # La validación de la reescritura ya abrió el PDF: no volver a parsearlo
+        return page_count, digest, True
+    try:
+        doc = fitz.open(src_path)
+    except Exception:
+        raise HTTPException(status_code=400, detail=f"PDF inválido o corrupto: {display_name}")
+    try:
+        return doc.page_count, digest, False
+    finally:
+        doc.close()
+
+
+def _prepare_source_pdfs(
+    sources: List[Tuple[str, str]],
+) -> Tuple[List[int], List[int], List[str], List[bool]]:
+    """
+    Normaliza, cuenta páginas y calcula el hash de los PDFs fuente (src_path, nombre),
+    en paralelo solo con PDF_WORKERS > 1. Devuelve el mapa global de páginas
+    (pdf_idx[g], page_idx[g]), los hashes y si cada PDF quedó reescrito.
+    """
+    workers = min(PDF_WORKERS, len(sources))
+    if workers > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            # map conserva el orden: el primer PDF inválido es el que se reporta
+            prepared = list(executor.map(lambda src: _prepare_source_pdf(*src), sources))
+    else:
+        prepared = [_prepare_source_pdf(*src) for src in sources]
+
+    pdf_idxs: List[int] = []
+    page_idxs: List[int] = []
+    for i, (count, _, _) in enumerate(prepared):
+        pdf_idxs.extend([i] * count)
+        page_idxs.extend(range(count))
+    return (
+        pdf_idxs,
+        page_idxs,
+        [digest for _, digest, _ in prepared],
+        [rewritten for _, _, rewritten in prepared],
+    )
+
+
 def _create_job_from_pdf_paths(pdf_paths: List[str]) -> Tuple[str, int]:
     if not pdf_paths:
         raise HTTPException(status_code=400, detail="Paquete sin PDFs.")
@@ -474,35 +963,32 @@ def _create_job_from_pdf_paths(pdf_paths: List[str]) -> Tuple[str, int]:
     os.makedirs(os.path.join(jdir, "pdfs"), exist_ok=True)
     os.makedirs(os.path.join(jdir, "cache"), exist_ok=True)
 
-    page_map: List[List[int]] = []
-    total_pages = 0
-
     try:
+        sources: List[Tuple[str, str]] = []
         for i, path in enumerate(pdf_paths):
             if not path.lower().endswith(".pdf"):
                 raise HTTPException(status_code=400, detail=f"Archivo no PDF: {os.path.basename(path)}")
             if os.path.getsize(path) > MAX_FILE_BYTES:
                 raise HTTPException(status_code=413, detail="Archivo demasiado grande.")
 
+            with open(path, "rb") as f:
+                if not _has_pdf_header(f.read(PDF_HEADER_SEARCH_BYTES)):
+                    raise HTTPException(status_code=400, detail=f"PDF inválido o corrupto: {os.path.basename(path)}")
+
             src_path = os.path.join(jdir, "pdfs", f"src_{i}.pdf")
             shutil.copyfile(path, src_path)
-            _rewrite_pdf_structure_inplace(src_path)
-
-            try:
-                doc = fitz.open(src_path)
-            except Exception:
-                raise HTTPException(status_code=400, detail=f"PDF inválido o corrupto: {os.path.basename(path)}")
-
-            for p in range(doc.page_count):
-                page_map.append([i, p])
-            total_pages += doc.page_count
-            doc.close()
+            sources.append((src_path, os.path.basename(path)))
 
+        pdf_idxs, page_idxs, pdf_hashes, pdf_rewritten = _prepare_source_pdfs(sources)
+        total_pages = len(pdf_idxs)
         meta = {
             "jobId": job_id,
             "files": len(pdf_paths),
             "totalPages": total_pages,
-            "page_map": page_map,
+            "pdf_idx": pdf_idxs,
+            "page_idx": page_idxs,
+            "pdf_hash": pdf_hashes,
+            "pdf_rewritten": pdf_rewritten,
             "createdAt": time.time(),
         }
         _save_meta(job_id, meta)
@@ -513,14 +999,135 @@ def _create_job_from_pdf_paths(pdf_paths: List[str]) -> Tuple[str, int]:
     return job_id, total_pages
 
 
-def _render_page_image(doc: fitz.Document, page_index: int, width: int) -> bytes:
+def _render_page_pixmap(
+    doc: fitz.Document,
+    page_index: int,
+    width: int,
+    annots: bool = True,
+) -> fitz.Pixmap:
     page = doc.load_page(page_index)
     # Escala para aproximar ancho deseado
     rect = page.rect
     zoom = width / rect.width
     mat = fitz.Matrix(zoom, zoom)
-    pix = page.get_pixmap(matrix=mat, alpha=False)
-    return pix.tobytes("png")
+    # El pixmap no depende del documento: se puede codificar fuera del lock del documento
+    return page.get_pixmap(matrix=mat, colorspace=fitz.csRGB, alpha=False, annots=annots)
+
+
+def _file_etag(st: os.stat_result) -> str:
+    return f'W/"{st.st_mtime_ns:x}-{st.st_size:x}"'
+
+
+def _conditional_file_response(
+    path: str,
+    media_type: str,
+    if_none_match: Optional[str],
+    cache_control: str,
+) -> Response:
+    """
+    FileResponse con ETag (mtime + tamaño): si el navegador ya tiene esa versión,
+    304 sin leer el archivo ni enviar el cuerpo.
+    """
+    st = os.stat(path)
+    etag = _file_etag(st)
+    headers = {"ETag": etag, "Cache-Control": cache_control}
+    if _etag_matches(etag, if_none_match):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=st)
+
+
+def _etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    return bool(if_none_match) and (
+        if_none_match.strip() == "*" or etag in (tag.strip() for tag in if_none_match.split(","))
+    )
+
+
+def _write_pixmap_file(path: str, pix: fitz.Pixmap, fmt: str = "png") -> None:
+    # MuPDF codifica directo al archivo: sin copia intermedia en bytes de Python.
+    # Escritura atómica, igual que _write_cache_file.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    if fmt == "jpeg":
+        pix.save(tmp_path, output="jpeg", jpg_quality=THUMB_JPG_QUALITY)
+    else:
+        pix.save(tmp_path, output="png")
+    os.replace(tmp_path, path)
+
+
+def _write_cache_file(path: str, data: bytes) -> None:
+    # Escritura atómica: un lector concurrente nunca ve un archivo a medias.
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
+
+
+def _thumb_cache_path(job_id: str, meta: dict, page_index: int) -> str:
+    hashes = meta.get("pdf_hash")
+    if hashes:
+        # Por contenido: volver a subir los mismos PDFs reutiliza las miniaturas
+        pdf_hash = hashes[meta["pdf_idx"][page_index]]
+        src_page = meta["page_idx"][page_index]
+        return os.path.join(THUMB_CACHE_ROOT, f"{pdf_hash}_{src_page}_{THUMB_WIDTH}.jpg")
+    return os.path.join(_job_dir(job_id), "cache", f"thumb_{page_index}.jpg")
+
+
+def _refresh_thumb(path_or_fd: Union[str, int], st: os.stat_result) -> os.stat_result:
+    # Renovar el mtime de una miniatura en uso para que el barrido no la borre mientras
+    # haya un job vivo que la usa. Solo pasado THUMB_REFRESH_AGE_SECONDS: el ETag sale
+    # del mtime y renovarla en cada acierto invalidaría la caché del navegador.
+    if time.time() - st.st_mtime <= THUMB_REFRESH_AGE_SECONDS:
+        return st
+    os.utime(path_or_fd)
+    return os.stat(path_or_fd)
+
+
+def _prerender_thumbs_for_pdf(job_id: str, pdf_idx: int, pages: List[Tuple[str, int]]) -> None:
+    for cache_path, src_page in pages:
+        try:
+            _refresh_thumb(cache_path, os.stat(cache_path))
+            continue
+        except FileNotFoundError:
+            pass
+        # Mismo documento que usan thumb/view; el lock se toma por página para que
+        # las peticiones del usuario se intercalen con el pre-render.
+        with _cached_source_pdf(job_id, pdf_idx) as doc:
+            pix = _render_page_pixmap(doc, src_page, THUMB_WIDTH, annots=False)
+        _write_pixmap_file(cache_path, pix, fmt="jpeg")
+
+
+def _prerender_thumbs(job_id: str) -> None:
+    """
+    Pre-renderiza las miniaturas de un job recién creado (tarea en background),
+    un hilo por PDF fuente sobre el documento compartido de _cached_source_pdf.
+    """
+    try:
+        meta = _load_meta(job_id)
+    except HTTPException:
+        return
+    # Las páginas globales se numeran PDF por PDF, así que pdf_idx es no decreciente:
+    # cada fuente es un tramo contiguo que se ubica con bisect.
+    pdf_idxs: List[int] = meta["pdf_idx"]
+    page_idxs: List[int] = meta["page_idx"]
+    per_pdf: Dict[int, List[Tuple[str, int]]] = {}
+    start = 0
+    while start < len(pdf_idxs):
+        pdf_idx = pdf_idxs[start]
+        end = bisect.bisect_right(pdf_idxs, pdf_idx, start)
+        per_pdf[pdf_idx] = [(_thumb_cache_path(job_id, meta, g), page_idxs[g]) for g in range(start, end)]
+        start = end
+
+    workers = max(1, min(PDF_WORKERS, len(per_pdf)))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(_prerender_thumbs_for_pdf, job_id, pdf_idx, pages)
+            for pdf_idx, pages in per_pdf.items()
+        ]
+        for future in futures:
+            try:
+                future.result()
+            except Exception:
+                # Best-effort: get_thumb renderiza bajo demanda si falta alguna
+                continue
 
 
 def _normalize_nit(nit_raw: str) -> str:
@@ -532,18 +1139,9 @@ def _normalize_nit(nit_raw: str) -> str:
     y devuelve SOLO el NIT base:
       - '900204617'
     """
-    s = (nit_raw or "").strip().upper()
-
-    # Quita puntos, comas y espacios
-    s = s.replace(".", "").replace(",", "").replace(" ", "")
-
-    # Si viene con DV (ej: 900204617-5), toma solo lo anterior al guion
-    if "-" in s:
-        s = s.split("-")[0]
-
-    # Deja solo dígitos
-    s = "".join(ch for ch in s if ch.isdigit())
-    return s
+    # Si viene con DV (ej: 900204617-5), toma solo lo anterior al guion y deja solo
+    # dígitos (puntos, comas y espacios incluidos) en una sola pasada del regex.
+    return _NON_DIGIT_RE.sub("", (nit_raw or "").partition("-")[0])
 
 
 def _normalize_invoice_code(code_raw: str) -> Optional[str]:
@@ -553,16 +1151,14 @@ def _normalize_invoice_code(code_raw: str) -> Optional[str]:
     if s.isdigit():
         return f"OCFE{s}"
     # OCFE or other prefix (ECUC, etc.) + digits
-    m = re.search(r"\b([A-Z]{3,6})\s*(\d{3,})\b", s)
+    m = _INVOICE_RE.search(s)
     if not m:
         return None
     prefix = m.group(1)
-    if prefix in {"NIT", "CUDE"}:
+    if prefix in _INVOICE_PREFIX_EXCLUDED:
         return None
-    digits = re.sub(r"\D", "", m.group(2))
-    if not digits:
-        return None
-    return f"{prefix}{digits}"
+    # El grupo 2 de _INVOICE_RE ya son solo dígitos (\d{3,})
+    return f"{prefix}{m.group(2)}"
 
 
 def _normalize_service(service_raw: Optional[str]) -> str:
@@ -570,27 +1166,49 @@ def _normalize_service(service_raw: Optional[str]) -> str:
     return s if s in SERVICE_IDS else "cuidador"
 
 
+@functools.lru_cache(maxsize=1)
+def _combining_marks_table() -> Dict[int, None]:
+    # Tabla para str.translate que elimina todas las marcas combinantes (categoría Mn).
+    # Se arma la primera vez que llega texto fuera de Latin-1: recorrer todo Unicode
+    # cuesta ~0.1 s y no debe pagarse al importar (ni en cada proceso de lote).
+    return {cp: None for cp in range(0x110000) if unicodedata.category(chr(cp)) == "Mn"}
+
+
 def _strip_accents(text: str) -> str:
-    return "".join(ch for ch in unicodedata.normalize("NFD", text) if unicodedata.category(ch) != "Mn")
+    if text.isascii():
+        return text
+    if max(text) <= "\xff":
+        # Caso típico en español (á, é, ñ, ü...): sin pasar por NFD
+        return text.encode("latin-1").translate(_LATIN1_ACCENTS_BYTES).decode("latin-1")
+    return unicodedata.normalize("NFD", text).translate(_combining_marks_table())
 
 
 def _page_kind(text: str) -> str:
-    upper = _strip_accents(text or "").upper()
-    if any(h in upper for h in _FEV_HINTS):
+    upper = _normalize_ocr_text(text or "")
+    if any(h in upper for h in _FEV_NEEDLES):
         return "fev"
-    if any(h in upper for h in _NC_HINTS):
+    if any(h in upper for h in _NC_NEEDLES):
         return "nc"
     return "other"
 
 
+# Una misma página se clasifica varias veces (texto embebido, pasadas fuerte y final):
+# se reutiliza la normalización en vez de repetir NFD + translate + upper.
+@functools.lru_cache(maxsize=256)
 def _normalize_ocr_text(text: str) -> str:
-    return _strip_accents(text or "").upper()
+    if not text:
+        return ""
+    if text.isascii():
+        return text.upper()
+    if max(text) <= "\xff" and "ß" not in text and "µ" not in text:
+        return text.encode("latin-1").translate(_LATIN1_FOLD_UPPER_BYTES).decode("latin-1")
+    return _strip_accents(text).upper()
 
 
-def _has_crc_table_hint(text: str) -> bool:
-    if not text:
+def _has_crc_table_hint(t: str) -> bool:
+    # Recibe texto ya normalizado (_normalize_ocr_text), como los demás _looks_like_*
+    if not t:
         return False
-    t = _normalize_ocr_text(text)
     dates = len(_DATE_RE.findall(t))
     times = len(_TIME_RE.findall(t))
     has_cuidador = "ATENCION CUIDADOR" in t or "CUIDADOR" in t
@@ -646,10 +1264,10 @@ def _looks_like_otros_servicios_crc_terapias(t: str) -> bool:
     if not t:
         return False
 
-    cleaned = re.sub(r"[^A-Z0-9 ]+", " ", t)
-    cleaned = re.sub(r"\s+", " ", cleaned).strip()
+    cleaned = _NON_ALNUM_SPACE_RE.sub(" ", t)
+    cleaned = _WHITESPACE_RE.sub(" ", cleaned).strip()
 
-    has_registro_individual = bool(re.search(r"REGISTR[O0]\s+INDIVID", cleaned))
+    has_registro_individual = bool(_REGISTRO_INDIVIDUAL_RE.search(cleaned))
     has_prestacion_servicios = "PRESTAC" in cleaned and "SERVICI" in cleaned
     has_terapia_context = "TERAPI" in cleaned or "APOYO TERAPEUT" in cleaned
     has_terapia_fields = "TIPO DE TERAPIA" in cleaned or "GAT REH" in cleaned
@@ -673,6 +1291,26 @@ def _looks_like_otros_servicios_crc_terapias(t: str) -> bool:
     return has_terapia_context and score >= 3
 
 
+def _compile_needles(patterns: Iterable[str]) -> Tuple[str, ...]:
+    """
+    Patrones listos para buscar en texto normalizado (sin tildes, mayúsculas):
+    las variantes con tilde se vuelven duplicadas y un patrón que contiene a otro
+    del mismo grupo nunca cambia el resultado, así que se descartan.
+    """
+    needles: List[str] = []
+    for p in patterns:
+        p = _strip_accents(p).upper()
+        if p not in needles:
+            needles.append(p)
+    return tuple(p for p in needles if not any(q != p and q in p for q in needles))
+
+
+_FEV_NEEDLES = _compile_needles(_FEV_HINTS)
+_NC_NEEDLES = _compile_needles(_NC_HINTS)
+_AUTO_RULES_STRONG_NEEDLES = [(cat, _compile_needles(patterns)) for cat, patterns in _AUTO_RULES_STRONG]
+_AUTO_RULES_FIXED_NEEDLES = [(cat, _compile_needles(patterns)) for cat, patterns in _AUTO_RULES_FIXED]
+
+
 def _classify_text(
     text: str,
     allow_crc_table: bool = False,
@@ -682,13 +1320,14 @@ def _classify_text(
         return None
     service = _normalize_service(service)
     t = _normalize_ocr_text(text)
-    has_opf_decisiones = bool(re.search(r"\bORDEN\s+MEDICA\s*\(?DECISIONES\)?\b", t))
+    has_opf_decisiones = bool(_OPF_DECISIONES_RE.search(t))
     has_hev_social_hint = (
         "REGISTRO DE ACTIVIDADES DE CUIDADO" in t
         or "REGISTRO DE ACTIVIDADES DE CUIDADOR" in t
         or "TRABAJO SOCIAL" in t
     )
-    has_historia_hint = "HISTORIA CLINICA" in t or "HISTORIA CLÍNICA" in t
+    # t ya viene sin tildes (_normalize_ocr_text)
+    has_historia_hint = "HISTORIA CLINICA" in t
     # Regla de negocio: "ORDEN MEDICA (DECISIONES)" siempre va a OPF.
     if has_opf_decisiones:
         return "OPF"
@@ -698,10 +1337,9 @@ def _classify_text(
     if "CERTIFICACION DETALLE DE CARGOS" in t or "CERTIFICACION DEL DETALLE DE CARGOS" in t:
         return "HEV"
     # Regla de negocio: OPF solo aplica si el texto contiene "ORDEN MEDICA".
-    has_opf_phrase = "ORDEN MEDICA" in t or "ORDEN MÉDICA" in t
+    has_opf_phrase = "ORDEN MEDICA" in t
     opf_context = (
         "ORDEN MEDICA (DECISIONES)" in t
-        or "ORDEN MÉDICA (DECISIONES)" in t
         or "DIAGNOSTICO PRINCIPAL" in t
         or "DIAGNOSTICOS SECUNDARIOS" in t
         or "MES INICIO" in t
@@ -715,14 +1353,14 @@ def _classify_text(
     if service == "otros_servicios":
         if _looks_like_otros_servicios_crc_terapias(t):
             return "CRC"
-        for cat, patterns in _AUTO_RULES_FIXED:
+        for cat, patterns in _AUTO_RULES_FIXED_NEEDLES:
             for p in patterns:
                 if p in t:
                     return cat
         if _looks_like_otros_servicios_pde(t):
             return "PDE"
         return "HEV"
-    for cat, patterns in _AUTO_RULES_STRONG:
+    for cat, patterns in _AUTO_RULES_STRONG_NEEDLES:
         for p in patterns:
             if p in t:
                 return cat
@@ -735,27 +1373,71 @@ def _text_is_useful(text: str) -> bool:
     return bool(text and len(text.strip()) >= OCR_MIN_TEXT_LEN)
 
 
-def _extract_page_text(job_id: str, page_index: int) -> str:
-    cache_txt = os.path.join(_job_dir(job_id), "cache", f"text_{page_index}.txt")
-    if os.path.exists(cache_txt):
-        with open(cache_txt, "r", encoding="utf-8", errors="ignore") as f:
-            return f.read()
+# (job_id, pdf_idx) -> texto embebido de todas sus páginas.
+_PDF_TEXTS_CACHE: "OrderedDict[Tuple[str, int], List[str]]" = OrderedDict()
+_PDF_TEXTS_LOCK = threading.Lock()
+_PDF_TEXTS_INFLIGHT: Dict[Tuple[str, int], threading.Lock] = {}
+
+
+def _pdf_page_texts(job_id: str, pdf_idx: int) -> List[str]:
+    """
+    Texto embebido de todas las páginas de un PDF fuente: se extrae abriendo el PDF
+    una sola vez y se guarda en un único archivo de caché (cache/text_pdf_{i}.json).
+    """
+    key = (job_id, pdf_idx)
+    with _PDF_TEXTS_LOCK:
+        texts = _PDF_TEXTS_CACHE.get(key)
+        if texts is not None:
+            _PDF_TEXTS_CACHE.move_to_end(key)
+            return texts
+        key_lock = _PDF_TEXTS_INFLIGHT.setdefault(key, threading.Lock())
+
+    # Un solo hilo extrae cada PDF; los demás esperan y reutilizan el resultado.
+    with key_lock:
+        with _PDF_TEXTS_LOCK:
+            texts = _PDF_TEXTS_CACHE.get(key)
+        if texts is not None:
+            return texts
+
+        cache_path = os.path.join(_job_dir(job_id), "cache", f"text_pdf_{pdf_idx}.json")
+        if os.path.exists(cache_path):
+            try:
+                with open(cache_path, "rb") as f:
+                    texts = orjson.loads(f.read())
+            except (OSError, orjson.JSONDecodeError):
+                texts = None
+        if texts is None:
+            doc = _open_source_pdf(job_id, pdf_idx)
+            try:
+                texts = [page.get_text("text") or "" for page in doc]
+            finally:
+                doc.close()
+            try:
+                _write_cache_file(cache_path, orjson.dumps(texts))
+            except OSError:
+                pass
 
+        with _PDF_TEXTS_LOCK:
+            _PDF_TEXTS_CACHE[key] = texts
+            while len(_PDF_TEXTS_CACHE) > PDF_TEXTS_CACHE_SIZE:
+                _PDF_TEXTS_CACHE.popitem(last=False)
+            _PDF_TEXTS_INFLIGHT.pop(key, None)
+    return texts
+
+
+def _extract_page_text(job_id: str, page_index: int) -> str:
     meta = _load_meta(job_id)
-    pdf_idx, src_page = meta["page_map"][page_index]
-    doc = _open_source_pdf(job_id, pdf_idx)
-    try:
-        page = doc.load_page(src_page)
-        text = page.get_text("text") or ""
-    finally:
-        doc.close()
+    texts = _pdf_page_texts(job_id, meta["pdf_idx"][page_index])
+    return texts[meta["page_idx"][page_index]]
 
-    try:
-        with open(cache_txt, "w", encoding="utf-8") as f:
-            f.write(text)
-    except OSError:
-        pass
-    return text
+
+def _ocr_variant(header_only: bool, classify: bool = False) -> Tuple[str, int]:
+    # (sufijo de caché, dpi): cada resolución de OCR completo tiene su propio archivo
+    if header_only:
+        return "_head", OCR_HEADER_DPI
+    if classify and OCR_CLASSIFY_DPI != OCR_DPI:
+        return f"_{OCR_CLASSIFY_DPI}dpi", OCR_CLASSIFY_DPI
+    return "", OCR_DPI
 
 
 def _ocr_cache_paths(job_id: str, page_index: int, suffix: str = "") -> Tuple[str, str]:
@@ -763,48 +1445,220 @@ def _ocr_cache_paths(job_id: str, page_index: int, suffix: str = "") -> Tuple[st
     return f"{base}.txt", f"{base}.png"
 
 
-def _ocr_page_text(job_id: str, page_index: int, header_only: bool = False) -> str:
+# Instancias PyTessBaseAPI reutilizables (una por hilo OCR concurrente como máximo).
+_TESS_POOL: "queue.LifoQueue" = queue.LifoQueue()
+
+
+def _new_tess_api():
+    last_error: Optional[Exception] = None
+    for lang in dict.fromkeys((OCR_LANG, "eng")):
+        try:
+            return tesserocr.PyTessBaseAPI(lang=lang, psm=int(OCR_PSM))
+        except RuntimeError as e:
+            last_error = e
+    raise RuntimeError(f"tesseract_init_failed: {last_error}")
+
+
+def _warm_tess_pool() -> None:
+    # Cargar el modelo de idioma al arrancar y no en la primera página que se clasifica.
+    try:
+        _TESS_POOL.put(_new_tess_api())
+    except Exception:
+        pass
+
+
+if OCR_ENABLED and tesserocr is not None:
+    threading.Thread(target=_warm_tess_pool, daemon=True).start()
+
+
+def _ocr_pixmap_in_process(pix: fitz.Pixmap, dpi: int) -> Optional[str]:
+    """
+    OCR del pixmap con tesserocr, sin pasar por PNG en disco.
+    Devuelve None si tesserocr no está disponible o falla (se usa el CLI).
+    """
+    if tesserocr is None:
+        return None
+    try:
+        try:
+            api = _TESS_POOL.get_nowait()
+        except queue.Empty:
+            api = _new_tess_api()
+        try:
+            api.SetImageBytes(pix.samples, pix.width, pix.height, pix.n, pix.stride)
+            api.SetSourceResolution(dpi)
+            return api.GetUTF8Text() or ""
+        finally:
+            api.Clear()
+            _TESS_POOL.put(api)
+    except Exception:
+        return None
+
+
+def _render_ocr_pixmap(page: fitz.Page, header_only: bool, dpi: int) -> fitz.Pixmap:
+    # Tesseract binariza en escala de grises: renderizar RGB solo triplica los datos.
+    mat = fitz.Matrix(dpi / 72.0, dpi / 72.0)
+    if header_only:
+        rect = page.rect
+        header_h = max(1.0, rect.height * OCR_HEADER_RATIO)
+        clip = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + header_h)
+        return page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False, clip=clip)
+    return page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False)
+
+
+def _run_tesseract_cli(image_path: str, out_base: str, dpi: int) -> bool:
+    # PGM no lleva resolución: se indica para que tesseract no asuma 70 dpi
+    cmd = ["tesseract", image_path, out_base, "-l", OCR_LANG, "--psm", str(OCR_PSM), "--dpi", str(dpi)]
+    res = subprocess.run(cmd, capture_output=True, text=True)
+    if res.returncode != 0 and OCR_LANG != "eng":
+        cmd[4] = "eng"
+        res = subprocess.run(cmd, capture_output=True, text=True)
+    return res.returncode == 0
+
+
+def _ocr_pages_cli_batch(
+    job_id: str,
+    page_indices: List[int],
+    header_only: bool,
+    classify: bool = False,
+    cancel_check: Optional[Callable[[], bool]] = None,
+) -> None:
+    """
+    OCR por CLI de varias páginas con un proceso tesseract por lote (lista de imágenes):
+    el modelo se carga una vez por lote y no por página. Hay OCR_WORKERS lotes en paralelo.
+    Los textos quedan en la caché de _ocr_page_text, que hace de a una las que falten.
+    """
+    suffix, dpi = _ocr_variant(header_only, classify)
+    pending = [i for i in page_indices if not os.path.exists(_ocr_cache_paths(job_id, i, suffix)[0])]
+    if len(pending) < 2:
+        return
+    meta = _load_meta(job_id)
+    work_dir = os.path.join(_job_dir(job_id), "cache", f"ocr_batch.{uuid.uuid4().hex}")
+    os.makedirs(work_dir)
+    try:
+
+        def run_chunk(n: int, chunk: List[int]) -> None:
+            # Cada lote renderiza sus páginas justo antes de su tesseract y las borra al
+            # terminar: en disco hay como mucho OCR_WORKERS lotes de imágenes a la vez.
+            images: List[str] = []
+            try:
+                for i in chunk:
+                    if cancel_check and cancel_check():
+                        return
+                    with _cached_source_pdf(job_id, meta["pdf_idx"][i]) as doc:
+                        pix = _render_ocr_pixmap(doc.load_page(meta["page_idx"][i]), header_only, dpi)
+                    path = os.path.join(work_dir, f"{i}.pgm")
+                    pix.save(path)
+                    images.append(path)
+                if cancel_check and cancel_check():
+                    return
+                list_path = os.path.join(work_dir, f"list_{n}.txt")
+                with open(list_path, "w", encoding="utf-8") as f:
+                    f.write("\n".join(images) + "\n")
+                out_base = os.path.join(work_dir, f"out_{n}")
+                if not _run_tesseract_cli(list_path, out_base, dpi):
+                    return
+                texts = (_read_cached_text(f"{out_base}.txt") or "").split("\f")
+                # Tesseract separa páginas con \f (algunas versiones también lo ponen al final)
+                if len(texts) == len(chunk) + 1 and not texts[-1].strip():
+                    texts.pop()
+                if len(texts) != len(chunk):
+                    return
+                for i, text in zip(chunk, texts):
+                    _write_cache_file(_ocr_cache_paths(job_id, i, suffix)[0], text.encode("utf-8"))
+            finally:
+                for path in images:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+        # Lotes de a lo sumo OCR_CLI_BATCH_PAGES páginas, OCR_WORKERS a la vez
+        size = min(OCR_CLI_BATCH_PAGES, -(-len(pending) // max(1, OCR_WORKERS)))
+        chunks = [pending[k:k + size] for k in range(0, len(pending), size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(max(1, OCR_WORKERS), len(chunks))) as executor:
+            list(executor.map(run_chunk, range(len(chunks)), chunks))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _prefetch_ocr_cli(
+    job_id: str,
+    total: int,
+    service: str,
+    cancel_check: Optional[Callable[[], bool]] = None,
+) -> None:
+    """
+    Sin tesserocr: adelanta por lotes el OCR que _page_text_for_classification pediría
+    página a página (misma selección: cabecera y luego OCR completo).
+    """
+    header_pages: List[int] = []
+    for i in range(total):
+        text = _extract_page_text(job_id, i)
+        if _text_is_useful(text) and (
+            not OCR_DOUBLE_CHECK or _classify_text(text, allow_crc_table=True, service=service)
+        ):
+            continue
+        header_pages.append(i)
+    _ocr_pages_cli_batch(job_id, header_pages, header_only=True, cancel_check=cancel_check)
+
+    full_pages: List[int] = []
+    for i in header_pages:
+        if _text_is_useful(_extract_page_text(job_id, i)):
+            continue
+        header_text = _read_cached_text(_ocr_cache_paths(job_id, i, "_head")[0])
+        if header_text is not None and not _classify_text(header_text, allow_crc_table=False, service=service):
+            full_pages.append(i)
+    _ocr_pages_cli_batch(job_id, full_pages, header_only=False, classify=True, cancel_check=cancel_check)
+
+
+def _ocr_page_text(
+    job_id: str,
+    page_index: int,
+    header_only: bool = False,
+    classify: bool = False,
+) -> str:
     if not OCR_ENABLED:
         return ""
-    suffix = "_head" if header_only else ""
+    suffix, dpi = _ocr_variant(header_only, classify)
     cache_txt, img_path = _ocr_cache_paths(job_id, page_index, suffix)
-    if os.path.exists(cache_txt):
-        with open(cache_txt, "r", encoding="utf-8") as f:
-            return f.read()
+    cached = _read_cached_text(cache_txt)
+    if cached is not None:
+        return cached
 
+    # Documento compartido del job: solo el render se serializa por PDF, el OCR
+    # (lo costoso) corre fuera del lock en paralelo con las demás páginas.
     meta = _load_meta(job_id)
-    pdf_idx, src_page = meta["page_map"][page_index]
-    doc = _open_source_pdf(job_id, pdf_idx)
-    try:
-        page = doc.load_page(src_page)
-        dpi = OCR_HEADER_DPI if header_only else OCR_DPI
-        zoom = dpi / 72.0
-        if header_only:
-            rect = page.rect
-            header_h = max(1.0, rect.height * OCR_HEADER_RATIO)
-            clip = fitz.Rect(rect.x0, rect.y0, rect.x1, rect.y0 + header_h)
-            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False, clip=clip)
-        else:
-            pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom), alpha=False)
-        pix.save(img_path)
-    finally:
-        doc.close()
+    with _cached_source_pdf(job_id, meta["pdf_idx"][page_index]) as doc:
+        pix = _render_ocr_pixmap(doc.load_page(meta["page_idx"][page_index]), header_only, dpi)
 
-    out_base = os.path.join(_job_dir(job_id), "cache", f"ocr_{page_index}{suffix}")
-    cmd = ["tesseract", img_path, out_base, "-l", OCR_LANG, "--psm", str(OCR_PSM)]
-    res = subprocess.run(cmd, capture_output=True, text=True)
-    if res.returncode != 0 and OCR_LANG != "eng":
-        cmd = ["tesseract", img_path, out_base, "-l", "eng", "--psm", str(OCR_PSM)]
-        subprocess.run(cmd, capture_output=True, text=True)
+    # Archivos intermedios con nombre único: otra petición puede estar haciendo OCR de la
+    # misma página (p. ej. ocr.txt?refresh=1 durante una clasificación). El resultado se
+    # publica con os.replace, así un lector nunca ve un .txt a medias.
+    tmp_base = f"{os.path.splitext(cache_txt)[0]}.{uuid.uuid4().hex}"
+    # Para el CLI basta un PGM sin comprimir (el pixmap ya es gris); PNG solo si se conserva
+    tmp_img = f"{tmp_base}.png" if OCR_KEEP_IMAGES else f"{tmp_base}.pgm"
 
-    text = ""
-    if os.path.exists(cache_txt):
-        with open(cache_txt, "r", encoding="utf-8", errors="ignore") as f:
-            text = f.read()
+    text = _ocr_pixmap_in_process(pix, dpi)
+    if OCR_KEEP_IMAGES or text is None:
+        pix.save(tmp_img)
+
+    if text is not None:
+        try:
+            _write_cache_file(cache_txt, text.encode("utf-8"))
+        except OSError:
+            pass
+    else:
+        _run_tesseract_cli(tmp_img, tmp_base, dpi)
+        text = _read_cached_text(f"{tmp_base}.txt") or ""
+        if os.path.exists(f"{tmp_base}.txt"):
+            os.replace(f"{tmp_base}.txt", cache_txt)
 
-    if not OCR_KEEP_IMAGES and os.path.exists(img_path):
+    if os.path.exists(tmp_img):
         try:
-            os.remove(img_path)
+            if OCR_KEEP_IMAGES:
+                os.replace(tmp_img, img_path)
+            else:
+                os.remove(tmp_img)
         except OSError:
             pass
 
@@ -813,7 +1667,7 @@ def _ocr_page_text(job_id: str, page_index: int, header_only: bool = False) -> s
 def _page_text_for_classification(
     job_id: str,
     page_index: int,
-    cancel_check: Optional[callable] = None,
+    cancel_check: Optional[Callable[[], bool]] = None,
     service: str = "cuidador",
 ) -> str:
     if cancel_check and cancel_check():
@@ -823,6 +1677,8 @@ def _page_text_for_classification(
     if _text_is_useful(text):
         if _classify_text(text, allow_crc_table=True, service=service):
             return text
+        if not OCR_DOUBLE_CHECK:
+            return text
         if cancel_check and cancel_check():
             raise RuntimeError("batch_cancelled")
         header_text = _ocr_page_text(job_id, page_index, header_only=True)
@@ -840,7 +1696,7 @@ def _page_text_for_classification(
     # 3) OCR completo (fallback para tablas / scans)
     if cancel_check and cancel_check():
         raise RuntimeError("batch_cancelled")
-    return _ocr_page_text(job_id, page_index, header_only=False)
+    return _ocr_page_text(job_id, page_index, header_only=False, classify=True)
 
 
 def _read_cached_text(path: str) -> Optional[str]:
@@ -872,18 +1728,16 @@ def _get_fecha_creacion_for_page(job_id: str, page_index: int) -> Optional[datet
     if date:
         return date
 
-    # 2) OCR cacheado (si existe, no ejecutar OCR nuevo)
-    txt_head, _ = _ocr_cache_paths(job_id, page_index, "_head")
-    text = _read_cached_text(txt_head)
-    date = _extract_fecha_creacion(text or "")
-    if date:
-        return date
-
-    txt_full, _ = _ocr_cache_paths(job_id, page_index, "")
-    text = _read_cached_text(txt_full)
-    date = _extract_fecha_creacion(text or "")
-    if date:
-        return date
+    # 2) OCR cacheado (si existe, no ejecutar OCR nuevo): cabecera, el de la
+    # clasificación automática y el de /ocr.txt
+    suffixes = dict.fromkeys(
+        (_ocr_variant(True)[0], _ocr_variant(False, classify=True)[0], _ocr_variant(False)[0])
+    )
+    for suffix in suffixes:
+        txt_path, _ = _ocr_cache_paths(job_id, page_index, suffix)
+        date = _extract_fecha_creacion(_read_cached_text(txt_path) or "")
+        if date:
+            return date
 
     return None
 
@@ -901,6 +1755,8 @@ def _extract_nit_invoice_from_text(text: str) -> Tuple[Optional[str], Optional[s
     normalized = _strip_accents(text or "")
     upper = normalized.upper()
 
+    # Búsquedas separadas a propósito: _INVOICE_RE puede coincidir con "NIT 900..." y esa
+    # primera coincidencia (descartada luego por el prefijo) decide el resultado.
     # Preferir entorno de FACTURA ELECTRONICA DE VENTA si existe
     fev_idx = upper.find("FACTURA ELECTRONICA DE VENTA")
     if fev_idx != -1:
@@ -918,36 +1774,61 @@ def _extract_nit_invoice_from_text(text: str) -> Tuple[Optional[str], Optional[s
         m_ocfe = _OCFE_RE.search(normalized)
         if m_ocfe:
             invoice = _normalize_invoice_code(f"OCFE{m_ocfe.group(1)}")
-    if not invoice and any(h in upper for h in _INVOICE_HINTS):
+    if not invoice and _INVOICE_HINTS_RE.search(upper):
         m_inv = _INVOICE_RE.search(upper)
         if m_inv:
             invoice = _normalize_invoice_code(m_inv.group(0))
 
     # 2) NIT (solo si aparece como NIT:xxxx o NIT xxxx)
     # Captura base y opcional DV. Ej: NIT: 900204617-5
-    m_nit = _NIT_RE.search(text)
+    m_nit = _NIT_RE.search(text or "")
     if m_nit:
         nit = _normalize_nit(m_nit.group(1))
 
     return nit, invoice
 
 
-def _extract_nit_invoice_from_doc(doc: fitz.Document) -> Tuple[Optional[str], Optional[str]]:
-    nit_candidates: List[Tuple[int, float, float, str, str]] = []
-    inv_candidates: List[Tuple[int, float, float, str, str]] = []
-
-    for i in range(doc.page_count):
-        page = doc.load_page(i)
-        page_text = page.get_text("text") or ""
+def _extract_nit_invoice_from_pages(
+    pages: Iterable[fitz.Page],
+) -> Tuple[Optional[str], Optional[str], List[str]]:
+    """
+    Devuelve (nit, factura, textos) donde textos es el texto plano de las páginas
+    leídas, para reutilizarlo en el fallback sin volver a extraerlo.
+    """
+    # Mejor candidato por (tipo, solo página FEV): el de menor (y, x) entre las páginas
+    # leídas y, ante empate, el primero visto. La lectura se corta en la primera página FEV
+    # con NIT y factura, así que las páginas siguientes ya no compiten.
+    best: Dict[Tuple[str, bool], Tuple[float, float, str]] = {}
+    page_texts: List[str] = []
+
+    def _offer(field: str, is_fev: bool, y: float, x: float, value: str) -> None:
+        for key in ((field, True), (field, False)) if is_fev else ((field, False),):
+            current = best.get(key)
+            if current is None or (y, x) < (current[0], current[1]):
+                best[key] = (y, x, value)
+
+    for page in pages:
+        # Una sola extracción por página: el texto plano se arma con los bloques de texto
+        # (tipo 0) en orden de lectura, sin un get_text("text") adicional.
+        text_blocks = [
+            b for b in page.get_text("blocks") if len(b) >= 5 and (len(b) < 7 or b[6] == 0)
+        ]
+        page_text = "\n".join(b[4] for b in text_blocks if b[4])
+        page_texts.append(page_text)
         kind = _page_kind(page_text)
+        is_fev = kind == "fev"
         height = page.rect.height or 1.0
         header_y = height * 0.4
-        blocks = page.get_text("blocks")
+        # Cabecera primero: orden (y, x), el mismo criterio con el que _offer compara
+        blocks = sorted(text_blocks, key=lambda b: (b[1], b[0]))
+        page_has_nit = False
+        page_has_inv = False
 
         for block in blocks:
-            if len(block) < 5:
-                continue
             x0, y0, x1, y1, text = block[:5]
+            # Solo la cabecera aporta candidatos
+            if y0 > header_y:
+                break
             if not text:
                 continue
             t = text.strip()
@@ -955,39 +1836,44 @@ def _extract_nit_invoice_from_doc(doc: fitz.Document) -> Tuple[Optional[str], Op
                 continue
 
             upper = t.upper()
-            in_header = y0 <= header_y
 
-            if in_header:
-                for m in _NIT_RE.finditer(t):
-                    nit = _normalize_nit(m.group(1))
-                    if len(nit) >= 6:
-                        nit_candidates.append((i, y0, x0, nit, kind))
+            for m in _NIT_RE.finditer(t):
+                nit = _normalize_nit(m.group(1))
+                if len(nit) >= 6:
+                    _offer("nit", is_fev, y0, x0, nit)
+                    page_has_nit = True
 
             # OCFE directo en header
-            if in_header:
-                m_ocfe = _OCFE_RE.search(t)
-                if m_ocfe:
-                    inv = _normalize_invoice_code(f"OCFE{m_ocfe.group(1)}")
-                    if inv:
-                        inv_candidates.append((i, y0, x0, inv, kind))
+            m_ocfe = _OCFE_RE.search(t)
+            if m_ocfe:
+                inv = _normalize_invoice_code(f"OCFE{m_ocfe.group(1)}")
+                if inv:
+                    _offer("inv", is_fev, y0, x0, inv)
+                    page_has_inv = True
 
             # Otros prefijos si hay pistas de factura en el bloque
-            if in_header and any(h in upper for h in _INVOICE_HINTS):
+            if _INVOICE_HINTS_RE.search(upper):
                 for m in _INVOICE_RE.finditer(upper):
                     inv = _normalize_invoice_code(m.group(0))
                     if inv:
-                        inv_candidates.append((i, y0, x0, inv, kind))
+                        _offer("inv", is_fev, y0, x0, inv)
+                        page_has_inv = True
+
+            # En página FEV ningún bloque posterior (mayor y, x) de esta página puede ganar
+            if is_fev and page_has_nit and page_has_inv:
+                break
 
-    # Preferir página de Factura Electrónica de Venta
-    nit_fev = [c for c in nit_candidates if c[4] == "fev"]
-    inv_fev = [c for c in inv_candidates if c[4] == "fev"]
+        # El encabezado FEV suele estar en la primera página: la primera página FEV con
+        # NIT y factura decide, aunque una página posterior tenga un candidato más arriba.
+        if is_fev and ("nit", True) in best and ("inv", True) in best:
+            break
 
-    def _pick(cands: List[Tuple[int, float, float, str, str]]) -> Optional[str]:
-        return min(cands, key=lambda x: (x[1], x[2]))[3] if cands else None
+    def _pick(field: str) -> Optional[str]:
+        # Preferir página de Factura Electrónica de Venta
+        found = best.get((field, True)) or best.get((field, False))
+        return found[2] if found else None
 
-    nit = _pick(nit_fev) or _pick(nit_candidates)
-    invoice = _pick(inv_fev) or _pick(inv_candidates)
-    return nit, invoice
+    return _pick("nit"), _pick("inv"), page_texts
 
 
 def _open_source_pdf(job_id: str, pdf_idx: int) -> fitz.Document:
@@ -997,32 +1883,208 @@ def _open_source_pdf(job_id: str, pdf_idx: int) -> fitz.Document:
     return fitz.open(path)
 
 
-def _build_pdf_from_global_pages(job_id: str, global_pages: List[int]) -> fitz.Document:
+def _iter_source_pages(job_id: str, global_pages: List[int]) -> Iterator[fitz.Page]:
+    """
+    Recorre páginas globales directamente sobre los PDFs fuente (solo lectura),
+    sin construir un PDF intermedio. Abre cada PDF fuente una sola vez.
+    """
     meta = _load_meta(job_id)
-    mapping: List[List[int]] = meta["page_map"]  # [[pdf_idx, page_idx], ...]
-    out = fitz.open()
+    pdf_idxs: List[int] = meta["pdf_idx"]
+    page_idxs: List[int] = meta["page_idx"]
     src_docs: Dict[int, fitz.Document] = {}
     try:
-        # Insertar páginas por orden dado
         for g in global_pages:
-            if g < 0 or g >= len(mapping):
+            if g < 0 or g >= len(pdf_idxs):
                 continue
-            pdf_idx, page_idx = mapping[g]
+            pdf_idx, page_idx = pdf_idxs[g], page_idxs[g]
+            if pdf_idx not in src_docs:
+                src_docs[pdf_idx] = _open_source_pdf(job_id, pdf_idx)
+            yield src_docs[pdf_idx].load_page(page_idx)
+    finally:
+        for doc in src_docs.values():
+            doc.close()
+
+
+class _CachedDoc:
+    __slots__ = ("doc", "lock", "users", "last_used")
+
+    def __init__(self, doc: fitz.Document) -> None:
+        self.doc = doc
+        self.lock = threading.Lock()
+        self.users = 0
+        self.last_used = time.time()
+
+
+# (job_id, pdf_idx) -> documento abierto, reutilizado entre requests de thumb/view.
+_DOC_CACHE: "OrderedDict[Tuple[str, int], _CachedDoc]" = OrderedDict()
+_DOC_CACHE_LOCK = threading.Lock()
+
+
+def _evict_source_pdfs_locked(now: float, job_id: Optional[str] = None) -> List[fitz.Document]:
+    # Requiere _DOC_CACHE_LOCK. Devuelve los documentos a cerrar fuera del lock.
+    stale: List[fitz.Document] = []
+    for key, entry in list(_DOC_CACHE.items()):
+        if entry.users:
+            continue
+        if (
+            key[0] == job_id
+            or len(_DOC_CACHE) > DOC_CACHE_SIZE
+            or now - entry.last_used > DOC_CACHE_IDLE_SECONDS
+        ):
+            del _DOC_CACHE[key]
+            stale.append(entry.doc)
+    return stale
+
+
+def _forget_source_pdfs(job_id: str) -> None:
+    with _DOC_CACHE_LOCK:
+        stale = _evict_source_pdfs_locked(time.time(), job_id=job_id)
+    for doc in stale:
+        doc.close()
+    with _PDF_TEXTS_LOCK:
+        for key in [k for k in _PDF_TEXTS_CACHE if k[0] == job_id]:
+            del _PDF_TEXTS_CACHE[key]
+
+
+@contextmanager
+def _cached_source_pdf(job_id: str, pdf_idx: int) -> Iterator[fitz.Document]:
+    """
+    Igual que _open_source_pdf pero mantiene el documento abierto entre requests.
+    MuPDF no admite uso concurrente del mismo documento: el acceso se serializa por PDF.
+    """
+    key = (job_id, pdf_idx)
+    with _DOC_CACHE_LOCK:
+        entry = _DOC_CACHE.get(key)
+        if entry is not None:
+            entry.users += 1
+            _DOC_CACHE.move_to_end(key)
+    if entry is None:
+        doc: Optional[fitz.Document] = _open_source_pdf(job_id, pdf_idx)
+        with _DOC_CACHE_LOCK:
+            entry = _DOC_CACHE.get(key)
+            if entry is None:
+                entry = _CachedDoc(doc)
+                _DOC_CACHE[key] = entry
+                doc = None
+            entry.users += 1
+        if doc is not None:
+            doc.close()
+    try:
+        with entry.lock:
+            yield entry.doc
+    finally:
+        with _DOC_CACHE_LOCK:
+            entry.users -= 1
+            entry.last_used = time.time()
+            stale = _evict_source_pdfs_locked(entry.last_used)
+        for doc in stale:
+            doc.close()
+
+
+def _build_pdf_from_global_pages(job_id: str, global_pages: List[int]) -> fitz.Document:
+    meta = _load_meta(job_id)
+    pdf_idxs: List[int] = meta["pdf_idx"]
+    page_idxs: List[int] = meta["page_idx"]
+    # Agrupar páginas consecutivas del mismo PDF fuente en rangos (pdf_idx, desde, hasta)
+    runs: List[List[int]] = []
+    for g in global_pages:
+        if g < 0 or g >= len(pdf_idxs):
+            continue
+        pdf_idx, page_idx = pdf_idxs[g], page_idxs[g]
+        if runs and runs[-1][0] == pdf_idx and runs[-1][2] + 1 == page_idx:
+            runs[-1][2] = page_idx
+        else:
+            runs.append([pdf_idx, page_idx, page_idx])
+
+    # Último rango de cada fuente: hasta ahí se conserva el mapa de objetos copiados
+    # (final=0), así fuentes/imágenes compartidas entre rangos se copian una sola vez.
+    last_run = {run[0]: i for i, run in enumerate(runs)}
+
+    out = fitz.open()
+    src_docs: Dict[int, fitz.Document] = {}
+    try:
+        # Insertar páginas por orden dado, un insert_pdf por rango
+        for i, (pdf_idx, from_page, to_page) in enumerate(runs):
             if pdf_idx not in src_docs:
                 src_docs[pdf_idx] = _open_source_pdf(job_id, pdf_idx)
-            out.insert_pdf(src_docs[pdf_idx], from_page=page_idx, to_page=page_idx)
+            out.insert_pdf(
+                src_docs[pdf_idx],
+                from_page=from_page,
+                to_page=to_page,
+                final=last_run[pdf_idx] == i,
+            )
     finally:
         for doc in src_docs.values():
             doc.close()
     return out
 
 
-def _zip_bytes(files: List[Tuple[str, bytes]]) -> bytes:
-    buf = BytesIO()
-    with zipfile.ZipFile(buf, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+class _ZipChunkSink(RawIOBase):
+    """
+    Destino no seekable para zipfile: acumula lo escrito hasta que se drena.
+    Permite emitir el ZIP por partes mientras se generan los PDFs.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        if len(b):
+            self._chunks.append(bytes(b))
+        return len(b)
+
+    def drain(self) -> List[bytes]:
+        # Se unen las escrituras pequeñas (cabeceras); los datos grandes se entregan
+        # sin copiar: unirlos duplicaría el PDF completo en memoria.
+        out: List[bytes] = []
+        small: List[bytes] = []
+        for chunk in self._chunks:
+            if len(chunk) < ZIP_STREAM_SMALL_CHUNK:
+                small.append(chunk)
+                continue
+            if small:
+                out.append(b"".join(small))
+                small = []
+            out.append(chunk)
+        if small:
+            out.append(b"".join(small))
+        self._chunks = []
+        return out
+
+
+def _iter_zip_stream(files: Iterable[Tuple[str, bytes]]) -> Iterator[bytes]:
+    sink = _ZipChunkSink()
+    with zipfile.ZipFile(sink, "w", compression=ZIP_COMPRESSION, compresslevel=ZIP_COMPRESSLEVEL) as zf:
         for filename, data in files:
             zf.writestr(filename, data)
-    return buf.getvalue()
+            # Sin esta referencia el PDF se libera apenas se entregan sus bytes,
+            # no cuando llega el siguiente
+            del data
+            yield from sink.drain()
+    # Directorio central
+    yield from sink.drain()
+
+
+def _write_zip_file(path: str, files: Iterable[Tuple[str, bytes]]) -> None:
+    # Cada PDF se escribe a disco apenas se genera: en memoria vive uno a la vez.
+    # Destino seekable: zipfile escribe directo al archivo, sin pasar por _ZipChunkSink
+    # (sin copias intermedias ni data descriptors).
+    tmp_path = f"{path}.tmp"
+    try:
+        with zipfile.ZipFile(
+            tmp_path, "w", compression=ZIP_COMPRESSION, compresslevel=ZIP_COMPRESSLEVEL
+        ) as zf:
+            for filename, data in files:
+                zf.writestr(filename, data)
+                del data
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
 
 
 # ----------------------------
@@ -1088,6 +2150,7 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Text-Source"],
 )
 
 
@@ -1097,14 +2160,12 @@ def health():
 
 
 @app.post("/jobs", response_model=CreateJobResponse)
-async def create_job(files: List[UploadFile] = File(...)):
+async def create_job(background: BackgroundTasks, files: List[UploadFile] = File(...)):
     if not files or len(files) < 1:
         raise HTTPException(status_code=400, detail="Debes subir al menos 1 PDF.")
     if len(files) > MAX_FILES:
         raise HTTPException(status_code=413, detail=f"Máximo {MAX_FILES} archivos por carga.")
 
-    _cleanup_expired_jobs()
-
     job_id = uuid.uuid4().hex
     jdir = _job_dir(job_id)
     os.makedirs(jdir, exist_ok=True)
@@ -1112,33 +2173,30 @@ async def create_job(files: List[UploadFile] = File(...)):
     os.makedirs(os.path.join(jdir, "cache"), exist_ok=True)
 
     try:
-        page_map: List[List[int]] = []
-        total_pages = 0
-
-        # Guardar PDFs y construir page_map global
+        # Guardar PDFs
+        sources: List[Tuple[str, str]] = []
         for i, uf in enumerate(files):
             if not _is_probably_pdf(uf):
                 raise HTTPException(status_code=400, detail=f"Archivo no PDF: {uf.filename}")
 
             src_path = os.path.join(jdir, "pdfs", f"src_{i}.pdf")
-            await _save_upload_file_limited(uf, src_path, MAX_FILE_BYTES)
-            _rewrite_pdf_structure_inplace(src_path)
-
-            try:
-                doc = fitz.open(src_path)
-            except Exception:
-                raise HTTPException(status_code=400, detail=f"PDF inválido o corrupto: {uf.filename}")
-
-            for p in range(doc.page_count):
-                page_map.append([i, p])
-            total_pages += doc.page_count
-            doc.close()
+            await _save_upload_file_limited(uf, src_path, MAX_FILE_BYTES, require_pdf=True)
+            sources.append((src_path, uf.filename))
 
+        # Normalizar y construir mapa global de páginas fuera del event loop
+        pdf_idxs, page_idxs, pdf_hashes, pdf_rewritten = await run_in_threadpool(
+            _prepare_source_pdfs, sources
+        )
+        total_pages = len(pdf_idxs)
         meta = {
             "jobId": job_id,
             "files": len(files),
             "totalPages": total_pages,
-            "page_map": page_map,  # global index -> [pdf_idx, page_idx]
+            # global index -> pdf_idx[g], page_idx[g]
+            "pdf_idx": pdf_idxs,
+            "page_idx": page_idxs,
+            "pdf_hash": pdf_hashes,
+            "pdf_rewritten": pdf_rewritten,
             "createdAt": time.time(),
         }
         _save_meta(job_id, meta)
@@ -1149,34 +2207,57 @@ async def create_job(files: List[UploadFile] = File(...)):
         shutil.rmtree(jdir, ignore_errors=True)
         raise HTTPException(status_code=500, detail="Error procesando archivos.")
 
+    if THUMB_PRERENDER:
+        background.add_task(_prerender_thumbs, job_id)
+    # Fuera del camino de la petición: corre después de enviar la respuesta (y del pre-render)
+    background.add_task(_cleanup_expired_jobs_throttled)
     return CreateJobResponse(jobId=job_id, totalPages=total_pages, files=len(files))
 
 
 @app.get("/jobs/{job_id}/pages/{page_index}/thumb.png")
-def get_thumb(job_id: str, page_index: int):
+def get_thumb(
+    job_id: str,
+    page_index: int,
+    if_none_match: Optional[str] = Header(default=None, alias="If-None-Match"),
+):
     meta = _load_meta(job_id)
     total = meta["totalPages"]
     if page_index < 0 or page_index >= total:
         raise HTTPException(status_code=404, detail="Página fuera de rango.")
 
-    cache_path = os.path.join(_job_dir(job_id), "cache", f"thumb_{page_index}.png")
-    if os.path.exists(cache_path):
-        with open(cache_path, "rb") as f:
-            return Response(content=f.read(), media_type="image/png")
-
-    pdf_idx, src_page = meta["page_map"][page_index]
-    doc = _open_source_pdf(job_id, pdf_idx)
-    img = _render_page_image(doc, src_page, THUMB_WIDTH)
-    doc.close()
-
-    with open(cache_path, "wb") as f:
-        f.write(img)
-
-    return Response(content=img, media_type="image/png")
+    cache_path = _thumb_cache_path(job_id, meta, page_index)
+    # El barrido de miniaturas compartidas puede borrar el archivo en cualquier momento:
+    # si falta al abrirlo es un fallo de caché y se vuelve a renderizar.
+    try:
+        return _thumb_response(cache_path, if_none_match)
+    except FileNotFoundError:
+        pass
+    pdf_idx, src_page = meta["pdf_idx"][page_index], meta["page_idx"][page_index]
+    with _cached_source_pdf(job_id, pdf_idx) as doc:
+        pix = _render_page_pixmap(doc, src_page, THUMB_WIDTH, annots=False)
+    _write_pixmap_file(cache_path, pix, fmt="jpeg")
+    return _thumb_response(cache_path, if_none_match)
+
+
+def _thumb_response(cache_path: str, if_none_match: Optional[str]) -> Response:
+    # Se lee con el archivo ya abierto (son pocos KB): un borrado posterior no afecta la
+    # respuesta, a diferencia de FileResponse, que abre el archivo recién al enviarlo.
+    with open(cache_path, "rb") as f:
+        st = _refresh_thumb(f.fileno(), os.fstat(f.fileno()))
+        etag = _file_etag(st)
+        headers = {"ETag": etag, "Cache-Control": PAGE_IMAGE_CACHE_CONTROL}
+        if _etag_matches(etag, if_none_match):
+            return Response(status_code=304, headers=headers)
+        data = f.read()
+    return Response(content=data, media_type="image/jpeg", headers=headers)
 
 
 @app.get("/jobs/{job_id}/pages/{page_index}/view.png")
-def get_view(job_id: str, page_index: int):
+def get_view(
+    job_id: str,
+    page_index: int,
+    if_none_match: Optional[str] = Header(default=None, alias="If-None-Match"),
+):
     meta = _load_meta(job_id)
     total = meta["totalPages"]
     if page_index < 0 or page_index >= total:
@@ -1184,21 +2265,24 @@ def get_view(job_id: str, page_index: int):
 
     cache_path = os.path.join(_job_dir(job_id), "cache", f"view_{page_index}.png")
     if CACHE_VIEW and os.path.exists(cache_path):
-        with open(cache_path, "rb") as f:
-            return Response(content=f.read(), media_type="image/png")
+        return _conditional_file_response(cache_path, "image/png", if_none_match, PAGE_IMAGE_CACHE_CONTROL)
 
-    pdf_idx, src_page = meta["page_map"][page_index]
-    doc = _open_source_pdf(job_id, pdf_idx)
-    img = _render_page_image(doc, src_page, VIEW_WIDTH)
-    doc.close()
+    pdf_idx, src_page = meta["pdf_idx"][page_index], meta["page_idx"][page_index]
+    with _cached_source_pdf(job_id, pdf_idx) as doc:
+        pix = _render_page_pixmap(doc, src_page, VIEW_WIDTH)
     if CACHE_VIEW:
-        with open(cache_path, "wb") as f:
-            f.write(img)
-    return Response(content=img, media_type="image/png")
+        _write_pixmap_file(cache_path, pix)
+        return _conditional_file_response(cache_path, "image/png", if_none_match, PAGE_IMAGE_CACHE_CONTROL)
+    return Response(content=pix.tobytes("png"), media_type="image/png")
 
 
 @app.get("/jobs/{job_id}/pages/{page_index}/ocr.txt")
-def get_ocr_text(job_id: str, page_index: int, refresh: bool = False):
+def get_ocr_text(
+    job_id: str,
+    page_index: int,
+    refresh: bool = False,
+    if_none_match: Optional[str] = Header(default=None, alias="If-None-Match"),
+):
     meta = _load_meta(job_id)
     total = meta["totalPages"]
     if page_index < 0 or page_index >= total:
@@ -1213,80 +2297,80 @@ def get_ocr_text(job_id: str, page_index: int, refresh: bool = False):
                     os.remove(path)
                 except OSError:
                     pass
+    txt_path, _ = _ocr_cache_paths(job_id, page_index)
+    if not refresh and not os.path.exists(txt_path):
+        # PDF con texto embebido suficiente: se devuelve sin hacer esperar al usuario
+        # por Tesseract (refresh=1 sigue forzando el OCR). X-Text-Source indica de dónde
+        # sale el texto, para que el cliente (p. ej. tools/ocr_debug.py) distinga ambos casos.
+        embedded = _extract_page_text(job_id, page_index)
+        if _text_is_useful(embedded):
+            return Response(
+                content=embedded,
+                media_type="text/plain; charset=utf-8",
+                headers={"X-Text-Source": "embedded"},
+            )
     text = _ocr_page_text(job_id, page_index)
-    return Response(content=text or "", media_type="text/plain; charset=utf-8")
-
-
-def _auto_classify_internal(job_id: str, service: str = "cuidador") -> Dict[str, Optional[Category]]:
-    meta = _load_meta(job_id)
-    total = meta["totalPages"]
-    classifications: Dict[str, Optional[Category]] = {}
-    service = _normalize_service(service)
-
-    if not OCR_ENABLED:
-        raise HTTPException(status_code=503, detail="OCR deshabilitado en el servidor.")
-
-    def _ocr_for_index(idx: int) -> Tuple[int, str]:
-        return idx, _page_text_for_classification(job_id, idx, service=service)
-
-    texts: Dict[int, str] = {}
-    if OCR_WORKERS > 1 and total > 1:
-        with concurrent.futures.ThreadPoolExecutor(max_workers=OCR_WORKERS) as executor:
-            for idx, text in executor.map(_ocr_for_index, range(total)):
-                texts[idx] = text
+    if os.path.exists(txt_path):
+        # refresh=1 reescribe el archivo: el ETag cambia y no se sirve un 304 viejo
+        response = _conditional_file_response(
+            txt_path, "text/plain; charset=utf-8", None if refresh else if_none_match, "no-cache"
+        )
     else:
-        for i in range(total):
-            texts[i] = _page_text_for_classification(job_id, i, service=service)
+        response = Response(content=text or "", media_type="text/plain; charset=utf-8")
+    response.headers["X-Text-Source"] = "ocr"
+    return response
 
-    # Primera pasada: solo reglas fuertes (sin estructura de tabla)
-    strong: Dict[int, Optional[str]] = {}
-    for i in range(total):
-        strong[i] = _classify_text(texts.get(i, ""), allow_crc_table=False, service=service)
-
-    # Determinar en qué PDFs hay encabezado CRC real
-    page_map: List[List[int]] = meta["page_map"]
-    per_pdf: Dict[int, List[int]] = {}
-    for g, pair in enumerate(page_map):
-        pdf_idx = pair[0]
-        per_pdf.setdefault(pdf_idx, []).append(g)
 
-    crc_pdf: Dict[int, bool] = {}
-    for pdf_idx, pages in per_pdf.items():
-        crc_pdf[pdf_idx] = any(strong.get(p) == "CRC" for p in pages)
-
-    # Segunda pasada: permitir tabla CRC solo si el PDF tiene encabezado CRC
-    for i in range(total):
-        pdf_idx = page_map[i][0]
-        if strong.get(i):
-            classifications[str(i)] = strong[i]
-        else:
-            allow_crc = crc_pdf.get(pdf_idx, False)
-            classifications[str(i)] = (
-                _classify_text(texts.get(i, ""), allow_crc_table=allow_crc, service=service) or "HEV"
-            )
+def _page_text_and_strong_category(
+    job_id: str,
+    page_index: int,
+    service: str,
+    cancel_check: Optional[Callable[[], bool]],
+) -> Tuple[str, Optional[str], bool]:
+    text = _page_text_for_classification(job_id, page_index, cancel_check=cancel_check, service=service)
+    cat = _classify_text(text, allow_crc_table=False, service=service)
+    # Pista de tabla CRC para la pasada final, mientras la normalización sigue en caché
+    crc_table = cat is None and bool(text) and _has_crc_table_hint(_normalize_ocr_text(text))
+    return text, cat, crc_table
 
-    # Propagar clasificación dentro del mismo PDF fuente si existe un encabezado fuerte unico
-    for pdf_idx, pages in per_pdf.items():
-        strong_hits = set()
-        for p in pages:
-            cat = strong.get(p)
-            if cat:
-                strong_hits.add(cat)
-        if len(strong_hits) == 1:
-            chosen = next(iter(strong_hits))
-            if chosen in {"FEV", "CRC", "PDE", "OPF"}:
-                for p in pages:
-                    # Solo propagar a páginas sin encabezado fuerte propio
-                    if not strong.get(p):
-                        classifications[str(p)] = chosen
 
-    return classifications
+def _classify_pages_text(
+    job_id: str,
+    page_indices: Iterable[int],
+    service: str = "cuidador",
+    cancel_check: Optional[Callable[[], bool]] = None,
+) -> Dict[int, Tuple[str, Optional[str], bool]]:
+    """
+    Texto, categoría por reglas fuertes y pista de tabla CRC de cada página, en paralelo (OCR_WORKERS).
+    Cada página se clasifica en cuanto termina su OCR, mientras siguen las demás.
+    El render usa el documento compartido del job (un lock por PDF); el OCR es concurrente.
+    """
+    indices = list(page_indices)
+    workers = min(OCR_WORKERS, len(indices))
+    if workers <= 1:
+        return {i: _page_text_and_strong_category(job_id, i, service, cancel_check) for i in indices}
+
+    results: Dict[int, Tuple[str, Optional[str], bool]] = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(_page_text_and_strong_category, job_id, i, service, cancel_check): i
+            for i in indices
+        }
+        try:
+            for fut in concurrent.futures.as_completed(futures):
+                results[futures[fut]] = fut.result()
+        except BaseException:
+            # Cancelación o error: no arrancar las páginas pendientes.
+            for fut in futures:
+                fut.cancel()
+            raise
+    return results
 
 
-def _auto_classify_internal_with_cancel(
+def _auto_classify_internal(
     job_id: str,
-    cancel_check: callable,
     service: str = "cuidador",
+    cancel_check: Optional[Callable[[], bool]] = None,
 ) -> Dict[str, Optional[Category]]:
     meta = _load_meta(job_id)
     total = meta["totalPages"]
@@ -1296,55 +2380,47 @@ def _auto_classify_internal_with_cancel(
     if not OCR_ENABLED:
         raise HTTPException(status_code=503, detail="OCR deshabilitado en el servidor.")
 
-    texts: Dict[int, str] = {}
-    for i in range(total):
-        texts[i] = _page_text_for_classification(
-            job_id,
-            i,
-            cancel_check=cancel_check,
-            service=service,
-        )
+    if tesserocr is None and not OCR_KEEP_IMAGES:
+        _prefetch_ocr_cli(job_id, total, service, cancel_check)
 
-    # Primera pasada: solo reglas fuertes (sin estructura de tabla)
-    strong: Dict[int, Optional[str]] = {}
-    for i in range(total):
-        strong[i] = _classify_text(texts.get(i, ""), allow_crc_table=False, service=service)
+    # Primera pasada (junto al OCR): solo reglas fuertes (sin estructura de tabla)
+    results = _classify_pages_text(job_id, range(total), service=service, cancel_check=cancel_check)
 
-    # Determinar en qué PDFs hay encabezado CRC real
-    page_map: List[List[int]] = meta["page_map"]
-    per_pdf: Dict[int, List[int]] = {}
-    for g, pair in enumerate(page_map):
-        pdf_idx = pair[0]
-        per_pdf.setdefault(pdf_idx, []).append(g)
+    # Agrupar las categorías fuertes por PDF fuente; el texto ya no hace falta
+    pdf_idxs: List[int] = meta["pdf_idx"]
+    strong: List[Optional[str]] = []
+    crc_table: List[bool] = []
+    strong_hits: Dict[int, set] = {}
+    for i in range(total):
+        _, cat, has_table = results.pop(i)
+        strong.append(cat)
+        crc_table.append(has_table)
+        if cat:
+            strong_hits.setdefault(pdf_idxs[i], set()).add(cat)
 
-    crc_pdf: Dict[int, bool] = {}
-    for pdf_idx, pages in per_pdf.items():
-        crc_pdf[pdf_idx] = any(strong.get(p) == "CRC" for p in pages)
+    # Propagar clasificación dentro del mismo PDF fuente si existe un encabezado fuerte unico
+    propagated: Dict[int, str] = {}
+    for pdf_idx, hits in strong_hits.items():
+        if len(hits) == 1:
+            chosen = next(iter(hits))
+            if chosen in {"FEV", "CRC", "PDE", "OPF"}:
+                propagated[pdf_idx] = chosen
 
-    # Segunda pasada: permitir tabla CRC solo si el PDF tiene encabezado CRC
+    # Segunda pasada: permitir tabla CRC solo si el PDF tiene encabezado CRC real
     for i in range(total):
-        pdf_idx = page_map[i][0]
-        if strong.get(i):
+        pdf_idx = pdf_idxs[i]
+        if strong[i]:
             classifications[str(i)] = strong[i]
+        elif pdf_idx in propagated:
+            # Solo se propaga a páginas sin encabezado fuerte propio
+            classifications[str(i)] = propagated[pdf_idx]
         else:
-            allow_crc = crc_pdf.get(pdf_idx, False)
-            classifications[str(i)] = (
-                _classify_text(texts.get(i, ""), allow_crc_table=allow_crc, service=service) or "HEV"
-            )
-
-    # Propagar clasificación dentro del mismo PDF fuente si existe un encabezado fuerte unico
-    for pdf_idx, pages in per_pdf.items():
-        strong_hits = set()
-        for p in pages:
-            cat = strong.get(p)
-            if cat:
-                strong_hits.add(cat)
-        if len(strong_hits) == 1:
-            chosen = next(iter(strong_hits))
-            if chosen in {"FEV", "CRC", "PDE", "OPF"}:
-                for p in pages:
-                    if not strong.get(p):
-                        classifications[str(p)] = chosen
+            # Sin regla fuerte, _classify_text con tabla CRC solo puede agregar la detección de
+            # tabla, que ya se evaluó en la primera pasada.
+            if crc_table[i] and "CRC" in strong_hits.get(pdf_idx, ()):
+                classifications[str(i)] = "CRC"
+            else:
+                classifications[str(i)] = "HEV"
 
     return classifications
 
@@ -1355,21 +2431,25 @@ def auto_classify(job_id: str, service: str = "cuidador"):
     return AutoClassifyResponse(classifications=classifications, ocrEnabled=OCR_ENABLED)
 
 
-def _process_job_bytes(job_id: str, req: ProcessRequest) -> Tuple[str, bytes]:
+def _prepare_job_output(job_id: str, req: ProcessRequest) -> Tuple[str, str, Dict[str, List[int]]]:
     meta = _load_meta(job_id)
     total = meta["totalPages"]
 
     # Construir listas por categoría
     pages_by_cat: Dict[str, List[int]] = {c: [] for c in CATEGORIES}
     for k, v in req.classifications.items():
-        try:
-            idx = int(k)
-        except ValueError:
+        if v is None:
             continue
+        # Claves normales ("12") sin pasar por try/except; el resto, como antes, con int()
+        if k.isascii() and k.isdigit():
+            idx = int(k)
+        else:
+            try:
+                idx = int(k)
+            except ValueError:
+                continue
         if idx < 0 or idx >= total:
             continue
-        if v is None:
-            continue
         pages_by_cat[v].append(idx)
 
     # Validación: FEV obligatorio
@@ -1381,19 +2461,16 @@ def _process_job_bytes(job_id: str, req: ProcessRequest) -> Tuple[str, bytes]:
     ocfe = _normalize_invoice_code(req.ocfeOverride) if req.ocfeOverride else None
 
     if not nit or not ocfe:
-        fev_doc = _build_pdf_from_global_pages(job_id, pages_by_cat["FEV"])
-        nit_found, ocfe_found = _extract_nit_invoice_from_doc(fev_doc)
+        with closing(_iter_source_pages(job_id, pages_by_cat["FEV"])) as fev_pages:
+            nit_found, ocfe_found, fev_texts = _extract_nit_invoice_from_pages(fev_pages)
 
         if not nit_found or not ocfe_found:
-            all_text = []
-            for i in range(fev_doc.page_count):
-                all_text.append(fev_doc.load_page(i).get_text("text") or "")
-            text = "\n".join(all_text)
+            # Sin corte temprano: fev_texts contiene todas las páginas FEV
+            text = "\n".join(fev_texts)
             fallback_nit, fallback_ocfe = _extract_nit_invoice_from_text(text)
             nit_found = nit_found or fallback_nit
             ocfe_found = ocfe_found or fallback_ocfe
 
-        fev_doc.close()
         if not nit:
             nit = nit_found
         if not ocfe:
@@ -1410,46 +2487,231 @@ def _process_job_bytes(job_id: str, req: ProcessRequest) -> Tuple[str, bytes]:
             },
         )
 
-    # Generar PDFs por categoría con páginas asignadas
-    output_files: List[Tuple[str, bytes]] = []
+    return nit, ocfe, pages_by_cat
 
-    for cat in CATEGORIES:
-        pages = pages_by_cat[cat]
-        if not pages:
-            continue
-        if cat == "HEV":
-            keyed = []
-            for idx in pages:
-                fecha = _get_fecha_creacion_for_page(job_id, idx)
-                keyed.append((1 if fecha is None else 0, fecha or datetime.max, idx))
-            pages = [k[2] for k in sorted(keyed)]
-        doc_out = _build_pdf_from_global_pages(job_id, pages)
-        pdf_bytes = doc_out.tobytes()
+
+def _whole_source_pdf_bytes(job_id: str, global_pages: List[int]) -> Optional[bytes]:
+    """
+    Si las páginas son un PDF fuente completo y en su orden, devuelve el archivo tal cual.
+    Solo si ese PDF se reescribió al subirlo (save con garbage=4, deflate, clean): la salida
+    no vuelve a pasar por tobytes(garbage=4, deflate=True), así que un original sin
+    normalizar se entregaría sin recolectar objetos ni comprimir.
+    """
+    if not global_pages:
+        return None
+    meta = _load_meta(job_id)
+    pdf_idxs: List[int] = meta["pdf_idx"]
+    first = global_pages[0]
+    if first < 0 or first >= len(pdf_idxs):
+        return None
+    pdf_idx = pdf_idxs[first]
+    # pdf_idx es creciente en el mapa global: el PDF ocupa un tramo contiguo
+    start = bisect.bisect_left(pdf_idxs, pdf_idx)
+    end = bisect.bisect_right(pdf_idxs, pdf_idx)
+    if first != start or len(global_pages) != end - start or global_pages != list(range(start, end)):
+        return None
+    # Jobs sin el dato (anteriores) o reescritura fallida: el original se reconstruye
+    rewritten = meta.get("pdf_rewritten") or []
+    if pdf_idx >= len(rewritten) or not rewritten[pdf_idx]:
+        return None
+    with _cached_source_pdf(job_id, pdf_idx) as doc:
+        # save() conserva el cifrado del original: ese caso también se reconstruye
+        if doc.metadata.get("encryption"):
+            return None
+    path = os.path.join(_job_dir(job_id), "pdfs", f"src_{pdf_idx}.pdf")
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _build_category_pdf(job_id: str, cat: str, pages: List[int], use_cache: bool = False) -> bytes:
+    if cat == "HEV" and len(pages) > 1:
+        # Orden por fecha de creación, no por posición en el PDF: no se puede omitir
+        # aunque las páginas ya vengan en orden de origen.
+        keyed = []
+        for idx in pages:
+            fecha = _get_fecha_creacion_for_page(job_id, idx)
+            keyed.append((1 if fecha is None else 0, fecha or datetime.max, idx))
+        pages = [k[2] for k in sorted(keyed)]
+
+    whole = _whole_source_pdf_bytes(job_id, pages)
+    if whole is not None:
+        return whole
+
+    # Jobs que se conservan pueden volver a descargarse: reutilizar el PDF ya armado.
+    cache_path = None
+    if use_cache:
+        key = hashlib.sha1(orjson.dumps([OUTPUT_PDF_GARBAGE, pages])).hexdigest()
+        cache_path = os.path.join(_job_dir(job_id), "cache", f"out_{key}.pdf")
+        try:
+            with open(cache_path, "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+
+    doc_out = _build_pdf_from_global_pages(job_id, pages)
+    try:
+        data = doc_out.tobytes(garbage=OUTPUT_PDF_GARBAGE, deflate=True)
+    finally:
         doc_out.close()
+    if cache_path:
+        try:
+            _write_cache_file(cache_path, data)
+        except OSError:
+            pass
+    return data
+
+
+def _iter_category_pdfs(
+    job_id: str,
+    pages_by_cat: Dict[str, List[int]],
+    nit: str,
+    ocfe: str,
+    use_cache: bool = False,
+) -> Iterator[Tuple[str, bytes]]:
+    # Generar PDFs por categoría con páginas asignadas (en orden de CATEGORIES)
+    work = [(cat, pages_by_cat[cat]) for cat in CATEGORIES if pages_by_cat[cat]]
+    if PDF_WORKERS > 1 and len(work) > 1:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(PDF_WORKERS, len(work))) as executor:
+            futures = deque(
+                (cat, executor.submit(_build_category_pdf, job_id, cat, pages, use_cache))
+                for cat, pages in work
+            )
+            # Sacar cada future al entregarlo: si no, la lista retiene todos los PDFs
+            # generados hasta terminar el ZIP.
+            while futures:
+                cat, future = futures.popleft()
+                yield f"{cat}_{nit}_{ocfe}.pdf", future.result()
+    else:
+        for cat, pages in work:
+            yield f"{cat}_{nit}_{ocfe}.pdf", _build_category_pdf(job_id, cat, pages, use_cache)
 
-        filename = f"{cat}_{nit}_{ocfe}.pdf"
-        output_files.append((filename, pdf_bytes))
 
-    zip_data = _zip_bytes(output_files)
+def _process_job_to_path(job_id: str, req: ProcessRequest, dest_path: str) -> str:
+    nit, ocfe, pages_by_cat = _prepare_job_output(job_id, req)
+    _write_zip_file(dest_path, _iter_category_pdfs(job_id, pages_by_cat, nit, ocfe))
 
     # Borrar temporales si no keep
     if not req.keepJob:
-        shutil.rmtree(_job_dir(job_id), ignore_errors=True)
+        _discard_job(job_id)
 
-    filename = f"{ocfe}.zip"
-    return filename, zip_data
+    return f"{ocfe}.zip"
+
+
+def _stream_job_zip(
+    job_id: str,
+    req: ProcessRequest,
+    pages_by_cat: Dict[str, List[int]],
+    nit: str,
+    ocfe: str,
+) -> Iterator[bytes]:
+    try:
+        yield from _iter_zip_stream(
+            _iter_category_pdfs(job_id, pages_by_cat, nit, ocfe, use_cache=req.keepJob)
+        )
+    finally:
+        # Borrar temporales si no keep
+        if not req.keepJob:
+            _discard_job(job_id)
 
 
 @app.post("/jobs/{job_id}/process")
 def process_job(job_id: str, req: ProcessRequest):
-    filename, zip_data = _process_job_bytes(job_id, req)
+    # Validaciones y NIT/OCFE antes de emitir bytes: los errores siguen siendo 400/422.
+    nit, ocfe, pages_by_cat = _prepare_job_output(job_id, req)
+    filename = f"{ocfe}.zip"
     return StreamingResponse(
-        BytesIO(zip_data),
+        _stream_job_zip(job_id, req, pages_by_cat, nit, ocfe),
         media_type="application/zip",
         headers={"Content-Disposition": f'attachment; filename="{filename}"'},
     )
 
 
+# batch_id -> Event de cancelación de los lotes que corren en este proceso. Con
+# BATCH_PROCESSES > 0 el lote corre en otro proceso y solo queda leer cancelRequested del meta.
+_BATCH_CANCEL_EVENTS: Dict[str, threading.Event] = {}
+_BATCH_CANCEL_EVENTS_LOCK = threading.Lock()
+
+
+def _batch_cancel_check(
+    batch_id: str,
+    cancel_event: threading.Event,
+    interval: float = 1.0,
+) -> Callable[[], bool]:
+    # Los hilos OCR consultan antes de cada etapa: el Event no cuesta nada; el batch meta
+    # se lee como mucho una vez por intervalo.
+    state = {"at": 0.0}
+    lock = threading.Lock()
+
+    def check() -> bool:
+        if cancel_event.is_set():
+            return True
+        with lock:
+            now = time.monotonic()
+            if now - state["at"] >= interval:
+                state["at"] = now
+                # Meta ilegible (503) o ausente (404): se toma como "no cancelado" y se vuelve
+                # a leer en el próximo intervalo. Propagar la excepción marcaría como error un
+                # paquete sano desde un hilo OCR.
+                try:
+                    if _load_batch_meta(batch_id).get("cancelRequested", False):
+                        cancel_event.set()
+                except (HTTPException, OSError):
+                    pass
+        return cancel_event.is_set()
+
+    return check
+
+
+def _process_batch_package(
+    pkg: dict,
+    service: str,
+    input_dir: str,
+    results_dir: str,
+    cancel_check: Callable[[], bool],
+) -> dict:
+    """
+    Procesa un paquete del lote (job, clasificación y ZIP de salida).
+    Devuelve los campos a actualizar en su entrada de meta.
+    """
+    update: dict = {}
+    try:
+        pkg_dir = os.path.join(input_dir, pkg["folder"])
+        pdfs = _collect_pdf_paths(pkg_dir)
+        job_id, _ = _create_job_from_pdf_paths(pdfs)
+        update["jobId"] = job_id
+
+        classifications = _auto_classify_internal(
+            job_id,
+            service=service,
+            cancel_check=cancel_check,
+        )
+        req = ProcessRequest(classifications=classifications, keepJob=False)
+        result_filename = f"{pkg['name']}.zip"
+        result_path = os.path.join(results_dir, result_filename)
+        download_name = _process_job_to_path(job_id, req, result_path)
+
+        update["resultFile"] = result_filename
+        update["downloadName"] = download_name
+        update["status"] = "done"
+    except RuntimeError as e:
+        if str(e) == "batch_cancelled":
+            update["status"] = "cancelled"
+            update["error"] = "cancelled"
+        else:
+            update["status"] = "error"
+            update["error"] = str(e)
+    except HTTPException as e:
+        update["status"] = "error"
+        if isinstance(e.detail, dict) and "message" in e.detail:
+            update["error"] = e.detail.get("message")
+        else:
+            update["error"] = str(e.detail)
+    except Exception as e:
+        update["status"] = "error"
+        update["error"] = str(e)
+    return update
+
+
 def _process_batch(batch_id: str, target_names: Optional[List[str]] = None) -> None:
     meta = _load_batch_meta(batch_id)
     service = _normalize_service(meta.get("service"))
@@ -1462,76 +2724,108 @@ def _process_batch(batch_id: str, target_names: Optional[List[str]] = None) -> N
     os.makedirs(results_dir, exist_ok=True)
 
     target_set = set(target_names or [])
-    done = 0
-    errors = 0
-
-    cancelled = False
-    for pkg in meta.get("packages", []):
-        if meta.get("cancelRequested"):
-            cancelled = True
-            break
-        if target_set and pkg.get("name") not in target_set:
-            continue
-        pkg["status"] = "processing"
-        pkg["error"] = None
-        _save_batch_meta(batch_id, meta)
+    targets = [
+        pkg for pkg in meta.get("packages", [])
+        if not target_set or pkg.get("name") in target_set
+    ]
+    cancel_event = threading.Event()
+    if meta.get("cancelRequested"):
+        cancel_event.set()
+    with _BATCH_CANCEL_EVENTS_LOCK:
+        _BATCH_CANCEL_EVENTS[batch_id] = cancel_event
+    cancel_check = _batch_cancel_check(batch_id, cancel_event)
+    # Los paquetes son independientes; meta se guarda desde varios hilos bajo este lock
+    meta_lock = threading.Lock()
+
+    def _save_progress() -> None:
+        # El meta vive en memoria durante el lote: antes de guardarlo se incorpora una
+        # cancelación pedida por /cancel, para no pisarla con la copia local.
+        if not cancel_event.is_set() and _load_batch_meta(batch_id).get("cancelRequested", False):
+            cancel_event.set()
+        if cancel_event.is_set():
+            meta["cancelRequested"] = True
+        _save_batch_meta(batch_id, meta, durable=False)
+
+    # all.zip se arma a medida que terminan los paquetes, mientras cada ZIP sigue en la
+    # caché de páginas, en vez de releerlos todos al final. Se publica con os.replace.
+    # Los miembros ya son ZIPs de PDFs: siempre STORED, deflate sobre deflate no reduce nada
+    # (ZIP_COMPRESS solo aplica a los ZIPs de cada paquete)
+    all_path = os.path.join(results_dir, "all.zip")
+    all_tmp_path = f"{all_path}.tmp"
+    all_zf = zipfile.ZipFile(all_tmp_path, "w", compression=zipfile.ZIP_STORED)
+    # Lock propio para all.zip: la copia de un paquete no frena los guardados de progreso
+    zip_lock = threading.Lock()
+
+    def _add_to_all_zip(result_file: str, arcname: Optional[str]) -> Optional[str]:
+        """Agrega el ZIP de un paquete a all.zip; devuelve el error si no se pudo."""
+        path = os.path.join(results_dir, result_file)
         try:
-            pkg_dir = os.path.join(input_dir, pkg["folder"])
-            pdfs = _collect_pdf_paths(pkg_dir)
-            job_id, _ = _create_job_from_pdf_paths(pdfs)
-            pkg["jobId"] = job_id
-
-            classifications = _auto_classify_internal_with_cancel(
-                job_id,
-                cancel_check=lambda: _load_batch_meta(batch_id).get("cancelRequested", False),
-                service=service,
-            )
-            req = ProcessRequest(classifications=classifications, keepJob=False)
-            download_name, zip_bytes = _process_job_bytes(job_id, req)
-
-            result_filename = f"{pkg['name']}.zip"
-            result_path = os.path.join(results_dir, result_filename)
-            with open(result_path, "wb") as f:
-                f.write(zip_bytes)
-
-            pkg["resultFile"] = result_filename
-            pkg["downloadName"] = download_name
-            pkg["status"] = "done"
-            done += 1
-        except RuntimeError as e:
-            if str(e) == "batch_cancelled":
-                pkg["status"] = "cancelled"
-                pkg["error"] = "cancelled"
-                cancelled = True
-            else:
-                pkg["status"] = "error"
-                pkg["error"] = str(e)
-                errors += 1
-        except HTTPException as e:
-            pkg["status"] = "error"
-            if isinstance(e.detail, dict) and "message" in e.detail:
-                pkg["error"] = e.detail.get("message")
-            else:
-                pkg["error"] = str(e.detail)
-            errors += 1
-        except Exception as e:
-            pkg["status"] = "error"
-            pkg["error"] = str(e)
-            errors += 1
-        _save_batch_meta(batch_id, meta)
+            # El origen se abre antes de crear la entrada: si falta, all.zip no queda con
+            # una entrada a medias. Copia en bloques de UPLOAD_CHUNK_BYTES (zf.write usa 8 KiB).
+            with open(path, "rb") as src:
+                zinfo = zipfile.ZipInfo.from_file(path, arcname or result_file, strict_timestamps=False)
+                zinfo.compress_type = zipfile.ZIP_STORED
+                with zip_lock, all_zf.open(zinfo, "w") as dest:
+                    shutil.copyfileobj(src, dest, UPLOAD_CHUNK_BYTES)
+        except (OSError, ValueError):
+            # Sin el detalle: el mensaje llega al cliente y no debe exponer rutas del servidor
+            return "No se pudo agregar el resultado al ZIP consolidado."
+        return None
 
-    # Build consolidated ZIP
-    all_path = os.path.join(results_dir, "all.zip")
-    with zipfile.ZipFile(all_path, "w", compression=zipfile.ZIP_DEFLATED) as zf:
+    def _run(pkg: dict) -> None:
+        # Tras una cancelación los paquetes restantes quedan pendientes (se marcan al final)
+        if cancel_event.is_set():
+            return
+        with meta_lock:
+            pkg["status"] = "processing"
+            pkg["error"] = None
+            _save_progress()
+        update = _process_batch_package(pkg, service, input_dir, results_dir, cancel_check)
+        if update.get("status") == "cancelled":
+            cancel_event.set()
+        if update.get("status") == "done":
+            zip_error = _add_to_all_zip(update["resultFile"], update.get("downloadName"))
+            if zip_error:
+                update["status"] = "error"
+                update["error"] = zip_error
+        with meta_lock:
+            pkg.update(update)
+            _save_progress()
+
+    try:
+        # Paquetes ya terminados en una corrida anterior (reproceso parcial). Los que están
+        # en targets se reprocesan y _run los agrega: aquí se agregarían dos veces.
         for pkg in meta.get("packages", []):
-            if pkg.get("status") != "done":
+            if not target_set or pkg.get("name") in target_set:
                 continue
-            result_file = pkg.get("resultFile")
-            if not result_file:
-                continue
-            file_path = os.path.join(results_dir, result_file)
-            arcname = pkg.get("downloadName") or result_file
-            zf.write(file_path, arcname=arcname)
+            if pkg.get("status") == "done" and pkg.get("resultFile"):
+                zip_error = _add_to_all_zip(pkg["resultFile"], pkg.get("downloadName"))
+                if zip_error:
+                    pkg["status"] = "error"
+                    pkg["error"] = zip_error
+
+        workers = min(BATCH_PACKAGE_WORKERS, len(targets))
+        if workers > 1:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+                for future in [executor.submit(_run, pkg) for pkg in targets]:
+                    future.result()
+        else:
+            for pkg in targets:
+                _run(pkg)
+        all_zf.close()
+        os.replace(all_tmp_path, all_path)
+    finally:
+        all_zf.close()
+        if os.path.exists(all_tmp_path):
+            try:
+                os.remove(all_tmp_path)
+            except OSError:
+                pass
+        with _BATCH_CANCEL_EVENTS_LOCK:
+            _BATCH_CANCEL_EVENTS.pop(batch_id, None)
+    if not cancel_event.is_set() and _load_batch_meta(batch_id).get("cancelRequested", False):
+        cancel_event.set()
+    cancelled = cancel_event.is_set()
 
     meta["allZip"] = "all.zip"
 
@@ -1540,6 +2834,8 @@ def _process_batch(batch_id: str, target_names: Optional[List[str]] = None) -> N
             client = _gcs_client()
             bucket = client.bucket(GCS_BUCKET)
             result_prefix = f"{_normalize_prefix(GCS_RESULTS_PREFIX)}{batch_id}/"
+            # (local_path, object_name, pkg); pkg None = all.zip
+            uploads: List[Tuple[str, str, Optional[dict]]] = []
             for pkg in meta.get("packages", []):
                 if pkg.get("status") != "done":
                     continue
@@ -1549,29 +2845,41 @@ def _process_batch(batch_id: str, target_names: Optional[List[str]] = None) -> N
                 local_path = os.path.join(results_dir, result_file)
                 if not os.path.exists(local_path):
                     continue
-                object_name = f"{result_prefix}{result_file}"
-                blob = bucket.blob(object_name)
-                blob.upload_from_filename(local_path, content_type="application/zip")
-                pkg["gcsResult"] = f"gs://{GCS_BUCKET}/{object_name}"
-
+                uploads.append((local_path, f"{result_prefix}{result_file}", pkg))
             if os.path.exists(all_path):
-                all_object = f"{result_prefix}all.zip"
-                blob = bucket.blob(all_object)
-                blob.upload_from_filename(all_path, content_type="application/zip")
-                meta["gcsAllZip"] = f"gs://{GCS_BUCKET}/{all_object}"
+                uploads.append((all_path, f"{result_prefix}all.zip", None))
+
+            def _upload(item: Tuple[str, str, Optional[dict]]) -> None:
+                local_path, object_name, _ = item
+                bucket.blob(object_name).upload_from_filename(local_path, content_type="application/zip")
+
+            # Subidas en paralelo: cada una es I/O de red
+            if uploads:
+                with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=min(GCS_UPLOAD_WORKERS, len(uploads))
+                ) as executor:
+                    futures = [(item, executor.submit(_upload, item)) for item in uploads]
+                    for (_, object_name, pkg), future in futures:
+                        future.result()
+                        if pkg is None:
+                            meta["gcsAllZip"] = f"gs://{GCS_BUCKET}/{object_name}"
+                        else:
+                            pkg["gcsResult"] = f"gs://{GCS_BUCKET}/{object_name}"
         except Exception as e:
             meta["gcsError"] = str(e)
 
-    done_count = sum(1 for p in meta.get("packages", []) if p.get("status") == "done")
-    error_count = sum(1 for p in meta.get("packages", []) if p.get("status") == "error")
-    pending_count = sum(1 for p in meta.get("packages", []) if p.get("status") in {"pending", "processing"})
+    status_counts = Counter(p.get("status") for p in meta.get("packages", []))
+    done_count = status_counts["done"]
+    error_count = status_counts["error"]
+    pending_count = status_counts["pending"] + status_counts["processing"]
 
     if cancelled:
         meta["status"] = "cancelled"
         meta["cancelRequested"] = False
-        for p in meta.get("packages", []):
-            if p.get("status") in {"pending", "processing"}:
-                p["status"] = "cancelled"
+        if pending_count:
+            for p in meta.get("packages", []):
+                if p.get("status") in {"pending", "processing"}:
+                    p["status"] = "cancelled"
     elif pending_count:
         meta["status"] = "processing"
     elif error_count and done_count:
@@ -1585,6 +2893,64 @@ def _process_batch(batch_id: str, target_names: Optional[List[str]] = None) -> N
     _save_batch_meta(batch_id, meta)
 
 
+_BATCH_POOL: Optional[concurrent.futures.ProcessPoolExecutor] = None
+_BATCH_POOL_LOCK = threading.Lock()
+# Modo hilo (BATCH_PROCESSES=0): lotes en un pool acotado; los que sobran esperan en cola
+_BATCH_THREAD_POOL: Optional[concurrent.futures.ThreadPoolExecutor] = None
+# Lotes en cola o corriendo en este proceso; pasado el límite se responde 429
+_BATCH_SLOTS = threading.BoundedSemaphore(BATCH_QUEUE_LIMIT)
+
+
+def _release_batch_slot(_future: concurrent.futures.Future) -> None:
+    _BATCH_SLOTS.release()
+
+
+def _start_batch_worker(batch_id: str, target_names: Optional[List[str]] = None) -> None:
+    global _BATCH_POOL, _BATCH_THREAD_POOL
+    if not _BATCH_SLOTS.acquire(blocking=False):
+        raise HTTPException(status_code=429, detail="Demasiados lotes en cola. Intenta de nuevo en unos minutos.")
+    with _BATCH_POOL_LOCK:
+        if BATCH_PROCESSES <= 0:
+            if _BATCH_THREAD_POOL is None:
+                _BATCH_THREAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=BATCH_WORKERS)
+            _BATCH_THREAD_POOL.submit(_process_batch, batch_id, target_names).add_done_callback(
+                _release_batch_slot
+            )
+            return
+        for _ in range(2):
+            if _BATCH_POOL is None:
+                # spawn y no fork: este proceso ya tiene hilos (OCR, PDFs, thumbs) con locks propios
+                _BATCH_POOL = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=BATCH_PROCESSES,
+                    mp_context=multiprocessing.get_context("spawn"),
+                )
+            try:
+                future = _BATCH_POOL.submit(_process_batch, batch_id, target_names)
+            except concurrent.futures.BrokenExecutor:
+                # Un proceso hijo murió (p. ej. OOM): se descarta el pool y se crea otro
+                _BATCH_POOL = None
+                continue
+            future.add_done_callback(_release_batch_slot)
+            return
+    _BATCH_SLOTS.release()
+    raise HTTPException(status_code=503, detail="No se pudo iniciar el procesamiento del lote.")
+
+
+def _start_batch_or_restore(
+    batch_id: str,
+    meta: dict,
+    prev_status: Optional[str],
+    target_names: Optional[List[str]] = None,
+) -> None:
+    # Si el lote no quedó en cola (429/503) no debe quedar marcado como "processing"
+    try:
+        _start_batch_worker(batch_id, target_names)
+    except HTTPException:
+        meta["status"] = prev_status
+        _save_batch_meta(batch_id, meta)
+        raise
+
+
 def _build_batch_from_zip(
     batch_id: str,
     zip_path: str,
@@ -1602,11 +2968,17 @@ def _build_batch_from_zip(
     except zipfile.BadZipFile:
         shutil.rmtree(bdir, ignore_errors=True)
         raise HTTPException(status_code=400, detail="ZIP inválido o corrupto.")
+    except HTTPException:
+        # Rutas inseguras o ZIP demasiado grande: no dejar el lote a medias en disco
+        shutil.rmtree(bdir, ignore_errors=True)
+        raise
 
-    pkg_folders = [
-        name for name in os.listdir(input_dir)
-        if os.path.isdir(os.path.join(input_dir, name)) and not name.startswith("__")
-    ]
+    # scandir: el tipo de cada entrada viene del dirent, sin un stat por carpeta
+    with os.scandir(input_dir) as it:
+        pkg_folders = [
+            entry.name for entry in it
+            if not entry.name.startswith("__") and entry.is_dir()
+        ]
     if not pkg_folders:
         shutil.rmtree(bdir, ignore_errors=True)
         raise HTTPException(status_code=400, detail="ZIP sin carpetas de paquetes.")
@@ -1660,7 +3032,9 @@ async def create_batch(
 
     zip_path = os.path.join(bdir, "batch.zip")
     await _save_upload_file_limited(file, zip_path, MAX_BATCH_BYTES)
-    return _build_batch_from_zip(
+    # Extracción y validación fuera del event loop
+    return await run_in_threadpool(
+        _build_batch_from_zip,
         batch_id,
         zip_path,
         bdir,
@@ -1693,10 +3067,9 @@ def create_batch_from_gcs(req: BatchFromGCSRequest):
 
     client = _gcs_client()
     bucket = client.bucket(bucket_name)
-    blob = bucket.blob(object_name)
-    if not blob.exists():
+    blob = bucket.get_blob(object_name)
+    if blob is None:
         raise HTTPException(status_code=404, detail="Objeto no encontrado en GCS.")
-    blob.reload()
     if blob.size and blob.size > MAX_BATCH_BYTES:
         raise HTTPException(status_code=413, detail=f"Máximo {MAX_BATCH_BYTES // (1024*1024)}MB por lote.")
 
@@ -1704,7 +3077,7 @@ def create_batch_from_gcs(req: BatchFromGCSRequest):
     bdir = _batch_dir(batch_id)
     os.makedirs(bdir, exist_ok=True)
     zip_path = os.path.join(bdir, "batch.zip")
-    blob.download_to_filename(zip_path)
+    _download_blob_to_path(blob, zip_path)
 
     resp = _build_batch_from_zip(
         batch_id,
@@ -1757,10 +3130,11 @@ def start_batch(batch_id: str):
         input_dir = os.path.join(_batch_dir(batch_id), "input")
         if not os.path.isdir(input_dir) or not os.listdir(input_dir):
             _restore_batch_input_from_gcs(batch_id, source_gcs)
+    prev_status = meta.get("status")
     meta["cancelRequested"] = False
     meta["status"] = "processing"
     _save_batch_meta(batch_id, meta)
-    threading.Thread(target=_process_batch, args=(batch_id,), daemon=True).start()
+    _start_batch_or_restore(batch_id, meta, prev_status)
     return {"batchId": batch_id, "status": "processing"}
 
 
@@ -1775,6 +3149,11 @@ def cancel_batch(batch_id: str):
     meta["cancelRequested"] = True
     meta["status"] = "cancelling"
     _save_batch_meta(batch_id, meta)
+    # Lote corriendo en este proceso: aviso inmediato, sin esperar la lectura del meta
+    with _BATCH_CANCEL_EVENTS_LOCK:
+        event = _BATCH_CANCEL_EVENTS.get(batch_id)
+    if event is not None:
+        event.set()
     return {"batchId": batch_id, "status": "cancelling"}
 
 
@@ -1784,10 +3163,11 @@ def retry_batch_errors(batch_id: str):
     error_pkgs = [p.get("name") for p in meta.get("packages", []) if p.get("status") == "error"]
     if not error_pkgs:
         return {"batchId": batch_id, "retried": 0}
+    prev_status = meta.get("status")
     meta["status"] = "processing"
     meta["cancelRequested"] = False
     _save_batch_meta(batch_id, meta)
-    threading.Thread(target=_process_batch, args=(batch_id, error_pkgs), daemon=True).start()
+    _start_batch_or_restore(batch_id, meta, prev_status, error_pkgs)
     return {"batchId": batch_id, "retried": len(error_pkgs)}
 
 
@@ -1817,12 +3197,16 @@ def download_batch_all(batch_id: str):
         raise HTTPException(status_code=404, detail="ZIP consolidado no disponible.")
     results_dir = os.path.join(_batch_dir(batch_id), "results")
     all_path = os.path.join(results_dir, meta["allZip"])
-    if not os.path.exists(all_path):
+    try:
+        # Un solo stat: FileResponse lo reutiliza en vez de volver a consultarlo
+        st = os.stat(all_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="ZIP consolidado no disponible.")
-    return StreamingResponse(
-        open(all_path, "rb"),
+    return FileResponse(
+        all_path,
         media_type="application/zip",
         headers={"Content-Disposition": 'attachment; filename="TIPIFICADO_LOTE.zip"'},
+        stat_result=st,
     )
 
 
@@ -1843,11 +3227,14 @@ def download_batch_package(batch_id: str, package_name: str):
         raise HTTPException(status_code=404, detail="Paquete no disponible.")
     results_dir = os.path.join(_batch_dir(batch_id), "results")
     file_path = os.path.join(results_dir, result_file)
-    if not os.path.exists(file_path):
+    try:
+        st = os.stat(file_path)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="Paquete no disponible.")
     download_name = pkg.get("downloadName") or f"{package_name}.zip"
-    return StreamingResponse(
-        open(file_path, "rb"),
+    return FileResponse(
+        file_path,
         media_type="application/zip",
         headers={"Content-Disposition": f'attachment; filename="{download_name}"'},
+        stat_result=st,
     )
@@ -0,0 +1,53 @@
+import os
+import tempfile
+import unittest
+import zipfile
+from unittest import mock
+
+os.environ.setdefault("TIPIFICADOR_JOB_ROOT", tempfile.mkdtemp())
+
+from app import main  # noqa: E402
+
+
+def _fake_package(pkg, service, input_dir, results_dir, cancel_check):
+    result_file = f"{pkg['name']}.zip"
+    with zipfile.ZipFile(os.path.join(results_dir, result_file), "w") as zf:
+        zf.writestr("doc.pdf", pkg["name"])
+    return {"status": "done", "resultFile": result_file, "downloadName": result_file}
+
+
+class BatchResumeTest(unittest.TestCase):
+    """all.zip tras cancelar un lote y volver a iniciarlo."""
+
+    def setUp(self):
+        self.batch_id = main.uuid.uuid4().hex
+        os.makedirs(os.path.join(main._batch_dir(self.batch_id), "results"))
+        # p1 terminó antes de la cancelación; p2 quedó cancelado
+        p1 = {"name": "p1", "folder": "p1"}
+        p1.update(_fake_package(p1, "cuidador", "", self._results_dir(), None))
+        p2 = {"name": "p2", "folder": "p2", "status": "cancelled", "error": "cancelled"}
+        main._save_batch_meta(self.batch_id, {"status": "cancelled", "packages": [p1, p2]})
+
+    def _results_dir(self):
+        return os.path.join(main._batch_dir(self.batch_id), "results")
+
+    def _all_zip_names(self):
+        with zipfile.ZipFile(os.path.join(self._results_dir(), "all.zip")) as zf:
+            return sorted(zf.namelist())
+
+    def test_full_start_after_cancel_adds_each_package_once(self):
+        with mock.patch.object(main, "_process_batch_package", side_effect=_fake_package) as run:
+            main._process_batch(self.batch_id)
+        self.assertEqual(run.call_count, 2)
+        self.assertEqual(self._all_zip_names(), ["p1.zip", "p2.zip"])
+        self.assertEqual(main._load_batch_meta(self.batch_id)["status"], "done")
+
+    def test_targeted_start_keeps_previous_results(self):
+        with mock.patch.object(main, "_process_batch_package", side_effect=_fake_package) as run:
+            main._process_batch(self.batch_id, ["p2"])
+        self.assertEqual(run.call_count, 1)
+        self.assertEqual(self._all_zip_names(), ["p1.zip", "p2.zip"])
+
+
+if __name__ == "__main__":
+    unittest.main()
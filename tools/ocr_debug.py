@@ -1,10 +1,21 @@
 #!/usr/bin/env python3
 import argparse
+import concurrent.futures
+import http.client
+import io
 import json
+import re
 import sys
 import textwrap
+import threading
+import urllib.parse
 import urllib.request
 import urllib.error
+from collections import deque
+from typing import Tuple
+
+# Una conexión HTTP persistente por hilo (urlopen abre una nueva en cada pedido)
+_LOCAL = threading.local()
 
 
 def _request_json(method: str, url: str):
@@ -14,17 +25,55 @@ def _request_json(method: str, url: str):
         return json.loads(resp.read().decode("utf-8"))
 
 
-def _request_text(url: str) -> str:
-    req = urllib.request.Request(url, method="GET")
-    with urllib.request.urlopen(req) as resp:
-        return resp.read().decode("utf-8", errors="ignore")
+def _connection(url: str) -> http.client.HTTPConnection:
+    parts = urllib.parse.urlsplit(url)
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None or _LOCAL.netloc != (parts.scheme, parts.netloc):
+        if conn is not None:
+            conn.close()
+        cls = http.client.HTTPSConnection if parts.scheme == "https" else http.client.HTTPConnection
+        conn = cls(parts.netloc, timeout=300)
+        _LOCAL.conn = conn
+        _LOCAL.netloc = (parts.scheme, parts.netloc)
+    return conn
+
+
+def _request_text(url: str) -> Tuple[str, str]:
+    parts = urllib.parse.urlsplit(url)
+    path = urllib.parse.urlunsplit(("", "", parts.path or "/", parts.query, ""))
+    for attempt in range(2):
+        conn = _connection(url)
+        try:
+            conn.request("GET", path)
+            resp = conn.getresponse()
+            body = resp.read()
+            break
+        except (http.client.RemoteDisconnected, ConnectionError):
+            # El servidor cerró la conexión ociosa: reconectar una vez
+            conn.close()
+            _LOCAL.conn = None
+            if attempt:
+                raise
+    if resp.status >= 400:
+        raise urllib.error.HTTPError(url, resp.status, resp.reason, resp.headers, io.BytesIO(body))
+    # X-Text-Source: "embedded" (texto del PDF) u "ocr" (Tesseract)
+    return body.decode("utf-8", errors="ignore"), resp.getheader("X-Text-Source") or "?"
+
+
+_WORD_RE = re.compile(r"\S+")
 
 
 def _shorten(text: str, length: int) -> str:
-    text = " ".join(text.split())
-    if len(text) <= length:
-        return text
-    return text[: length - 3] + "..."
+    # Igual a " ".join(text.split()) recortado, pero deja de recorrer el texto en
+    # cuanto se supera el largo (una página OCR completa suele ser mucho más larga)
+    words = []
+    size = -1
+    for m in _WORD_RE.finditer(text):
+        words.append(m.group())
+        size += len(words[-1]) + 1
+        if size > length:
+            return " ".join(words)[: length - 3] + "..."
+    return " ".join(words)
 
 
 def main() -> int:
@@ -51,13 +100,19 @@ def main() -> int:
     parser.add_argument(
         "--refresh",
         action="store_true",
-        help="Forzar re-OCR por pagina (ignora cache)",
+        help="Forzar re-OCR por pagina (ignora cache y texto embebido)",
     )
     parser.add_argument(
         "--full",
         action="store_true",
         help="Mostrar texto OCR completo (default: recorte)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=4,
+        help="Paginas pedidas en paralelo (default: 4)",
+    )
     args = parser.parse_args()
 
     base = args.api.rstrip("/")
@@ -81,21 +136,39 @@ def main() -> int:
     for cat in sorted(counts.keys()):
         sys.stdout.write(f"  {cat}: {counts[cat]}\n")
 
-    shown = 0
+    refresh = "true" if args.refresh else "false"
+    pages = []
     for k in keys:
         cat = classifications.get(k) or "SIN"
         if args.only_missing and cat != "SIN":
             continue
-        idx = int(k)
-        refresh = "true" if args.refresh else "false"
+        pages.append((int(k), cat))
+
+    def _fetch(idx: int) -> Tuple[str, str]:
+        return _request_text(f"{base}/jobs/{job_id}/pages/{idx}/ocr.txt?refresh={refresh}")
+
+    shown = 0
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, args.workers))
+    # Ventana de pedidos en curso: se imprime en orden y, con --limit, no se pide OCR
+    # de muchas más paginas de las que se van a mostrar
+    pending = deque()
+    next_page = 0
+    while True:
+        while next_page < len(pages) and len(pending) < max(1, args.workers):
+            idx, cat = pages[next_page]
+            pending.append((idx, cat, executor.submit(_fetch, idx)))
+            next_page += 1
+        if not pending:
+            break
+        idx, cat, future = pending.popleft()
         try:
-            text = _request_text(f"{base}/jobs/{job_id}/pages/{idx}/ocr.txt?refresh={refresh}")
+            text, source = future.result()
         except urllib.error.HTTPError as e:
             sys.stderr.write(f"Error OCR pagina {idx}: {e.read().decode('utf-8')}\n")
             continue
 
         sys.stdout.write("\n")
-        sys.stdout.write(f"Pagina #{idx + 1}  CAT={cat}\n")
+        sys.stdout.write(f"Pagina #{idx + 1}  CAT={cat}  FUENTE={source}\n")
         if args.full:
             sys.stdout.write(text + "\n")
         else:
@@ -105,6 +178,7 @@ def main() -> int:
         if args.limit and shown >= args.limit:
             break
 
+    executor.shutdown(wait=True, cancel_futures=True)
     return 0
 
 